@@ -3,6 +3,8 @@ import shutil
 from pathlib import Path
 import logging
 
+from output_compression import open_output, plain_name
+
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -35,13 +37,17 @@ for crystal in base_dir.iterdir():
                     if k_dir.exists():
                         logging.info(f"Processing k-value: {k_value}")
                         # Find and copy .out files
-                        for out_file in k_dir.glob('*.out'):
+                        for out_file in sorted(k_dir.glob('*.out*')):
+                            if not plain_name(out_file.name).endswith('.out'):
+                                continue
                             try:
                                 # Create new filename
                                 new_filename = f"{crystal.name}_{polymorph.name}_k-value-{k_value}.out"
                                 new_filepath = temp_dir / new_filename
                                 
-                                shutil.copy(out_file, new_filepath)
+                                # Compressed outputs are copied out plain for the energy scripts
+                                with open_output(out_file) as source, open(new_filepath, 'w') as destination:
+                                    shutil.copyfileobj(source, destination)
                                 copied_files += 1
                                 logging.info(f"Copied and renamed: {new_filename}")
                             except Exception as e:
@@ -1,9 +1,36 @@
 import os
+import glob
 import math
+import hashlib
 
 # Define the main directory and the output file path
 main_directory = "results-3"  # Root directory
 output_file_path = "commands.txt"
+deduplicate = False  # Set to True to run dmacrys once per set of identical inputs and copy the .dmaout to the rest
+potential_digests = {}  # Hash of each potential file by inode, read once however many .dmain files share it
+
+def file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).digest()
+
+def potential_digest(path):
+    """Hash a potential file only the first time it, or a link to it, is seen."""
+    info = os.stat(path)
+    key = (info.st_dev, info.st_ino, info.st_mtime_ns)
+    if key not in potential_digests:
+        potential_digests[key] = file_digest(path)
+    return potential_digests[key]
+
+def input_key(folder, dmain_file):
+    """Hash a .dmain file with the potential files dmacrys reads next to it."""
+    sha = hashlib.sha256()
+    sha.update(b"dmain")
+    sha.update(file_digest(os.path.join(folder, dmain_file)))
+    for pattern in ["fit.pots", "*.dma", "*.mols"]:
+        for path in sorted(glob.glob(os.path.join(folder, pattern))):
+            sha.update(os.path.basename(path).encode())
+            sha.update(potential_digest(path))
+    return sha.hexdigest()
 
 # List of crystal directories to process
 crystal_directories = [
@@ -13,6 +40,8 @@ crystal_directories = [
 
 # Collect all commands in a list
 all_commands = []
+command_for_key = {}  # Index into all_commands of the run computing each set of inputs
+duplicates = 0
 
 # Iterate over each crystal directory
 for crystal_dir in crystal_directories:
@@ -34,11 +63,24 @@ for crystal_dir in crystal_directories:
                 base_name = os.path.splitext(file)[0]
                 # Construct the full path for the cd command
                 full_cd_path = root
+                if deduplicate:
+                    key = input_key(root, file)
+                    if key in command_for_key:
+                        # Identical inputs already run elsewhere: copy that output once that run succeeds
+                        index, source = command_for_key[key]
+                        all_commands[index] = (all_commands[index].rstrip("\n")
+                                               + f" && cp {source} {os.path.abspath(os.path.join(root, base_name))}.dmaout\n")
+                        duplicates += 1
+                        continue
+                    command_for_key[key] = (len(all_commands), f"{os.path.abspath(os.path.join(root, base_name))}.dmaout")
                 # Construct the command with absolute paths
                 command = f"cd {full_cd_path} ; dmacrys2.2.1 < {file} > {base_name}.dmaout\n"
                 # Add the command to the list
                 all_commands.append(command)
 
+if deduplicate:
+    print(f"Folded {duplicates} .dmain files with identical inputs into the runs that compute them")
+
 # Split the commands into 10 equal parts
 num_files = 3
 commands_per_file = math.ceil(len(all_commands) / num_files)
@@ -2,6 +2,8 @@ import os
 import csv
 import re
 
+from output_compression import open_output, plain_name
+
 # Define input and output directories
 input_dir = "crystal-files"
 output_dir = "raw-energy-files"
@@ -22,7 +24,7 @@ def parse_out_file(file_path):
         "Total number of sampled unique k-points": None
     }
     
-    with open(file_path, 'r') as file:
+    with open_output(file_path) as file:
         for line in file:
             if "Neat vibrational energy" in line:
                 data["Neat vibrational energy"] = safe_float_convert(line.split("=")[1].strip())
@@ -41,7 +43,7 @@ def parse_out_file(file_path):
 # Loop through all subdirectories and process .out files
 for root, dirs, files in os.walk(input_dir):
     for file in files:
-        if file.endswith(".out"):
+        if plain_name(file).endswith(".out"):  # Plain or compressed
             # Extract crystal name, ID, and k-point value from the path
             parts = root.split(os.sep)
             crystal_name = parts[-4]  # Changed from -3 to -4
@@ -15,6 +15,8 @@ import csv
 from glob import glob
 from collections import defaultdict
 
+from output_compression import open_output, plain_name
+
 def format_number(number):
     return f"{number:.6f}"
 
@@ -24,7 +26,7 @@ def calculate_energies(file_path):
     total_phonons = 0
     kde_energy = 0
 
-    with open(file_path, 'r') as f:
+    with open_output(file_path) as f:
         for line in f:
             if 'Neat vibrational energy =' in line:
                 neat_vib_energy = float(line.split('=')[1].split()[0])
@@ -61,7 +63,8 @@ def main():
                 k_point = float(os.path.basename(k_value_dir).split('_')[-1])
                 
                 if 0.1 <= k_point <= 0.4:
-                    out_file = glob(os.path.join(k_value_dir, '*.out'))
+                    out_file = [path for path in sorted(glob(os.path.join(k_value_dir, '*.out*')))
+                                if plain_name(path).endswith('.out')]  # Plain or compressed
                     if out_file:
                         energies = calculate_energies(out_file[0])
                         data[f"{crystal_name}_{crystal_type}"][k_point] = energies
@@ -1,6 +1,8 @@
 import os
 import csv
 
+from output_compression import open_output, plain_name
+
 def extract_k_points(directory):
     # List to store extracted data
     results = []
@@ -8,10 +10,10 @@ def extract_k_points(directory):
     # Walk through the directory and process each file
     for root, _, files in os.walk(directory):
         for file in files:
-            if file.endswith(".out"):  # Process all .out files
+            if plain_name(file).endswith(".out"):  # Process all .out files, plain or compressed
                 file_path = os.path.join(root, file)
                 try:
-                    with open(file_path, 'r') as f:
+                    with open_output(file_path) as f:
                         for line in f:
                             if "Total number of sampled unique k-points:" in line:
                                 # Extract the number of k-points from the line
@@ -1,10 +1,14 @@
 import os
 import csv
+import json
 from tqdm import tqdm  # For progress bar
 
+from output_compression import open_output, plain_name
+
 # Define the base directory and output directory
 base_dir = "crystal-files"
 output_dir = "time-data"
+record_name = "phonon-record.json"  # Timing footers of folders pruned by energy_and_error_calculations/retention.py
 
 # Ensure the output directory exists
 os.makedirs(output_dir, exist_ok=True)
@@ -12,7 +16,7 @@ os.makedirs(output_dir, exist_ok=True)
 # Function to parse the dmaout file and extract timing information
 def parse_dmaout(file_path):
     timings = {}
-    with open(file_path, "r") as file:
+    with open_output(file_path) as file:
         lines = file.readlines()
         for line in lines:
             if "Time to set things up" in line:
@@ -41,11 +45,16 @@ def process_dmaout_files(base_dir, output_dir):
     dmaout_files = []
     for root, _, files in os.walk(base_dir):
         for file_name in files:
-            if file_name.endswith(".dmaout"):
-                dmaout_files.append(os.path.join(root, file_name))
+            if plain_name(file_name).endswith(".dmaout"):  # Plain or compressed
+                dmaout_files.append((os.path.join(root, file_name), None))
+            elif file_name == record_name:
+                # The .dmaout files of a pruned folder are gone, but their footers are kept here
+                with open(os.path.join(root, file_name), "r") as record_file:
+                    for dmaout_name, timings in json.load(record_file).get("timings", {}).items():
+                        dmaout_files.append((os.path.join(root, dmaout_name), timings))
     
     # Process each dmaout file with a progress bar
-    for file_path in tqdm(dmaout_files, desc="Processing dmaout files", unit="file"):
+    for file_path, timing_data in tqdm(dmaout_files, desc="Processing dmaout files", unit="file"):
         # Extract metadata from the file path
         relative_path = os.path.relpath(os.path.dirname(file_path), base_dir)
         parts = relative_path.split(os.sep)
@@ -57,15 +66,16 @@ def process_dmaout_files(base_dir, output_dir):
             k_value = k_value_folder.replace("k_value_", "")
             
             # Extract ld value from the file name
-            file_name = os.path.basename(file_path)
+            file_name = plain_name(os.path.basename(file_path))
             if ".res_" in file_name:
                 ld_value = file_name.split(".res_")[1].split(".dmaout")[0]
             else:
                 print(f"Warning: '{file_name}' does not contain '.res_', skipping this file.")
                 continue  # Skip this iteration and move to the next file
             
-            # Parse the dmaout file
-            timing_data = parse_dmaout(file_path)
+            # Parse the dmaout file, unless its timings came from a record
+            if timing_data is None:
+                timing_data = parse_dmaout(file_path)
             
             # Prepare output CSV path with separated directories for polymorph and k-value
             output_file_name = f"{crystal}_{polymorph}_{ld_value}_k-value-{k_value}_timings.csv"
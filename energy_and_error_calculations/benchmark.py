@@ -0,0 +1,146 @@
+'''
+Throughput benchmark of the calculations.py orchestration. It runs against the stand-in tools in
+stub_tools/, so it needs neither the licensed neighcrys/dmacrys2.2.1 binaries nor the real
+AutoLD.py/AutoFree.py.
+
+For each worker count a fresh tree of synthetic structures is taken through the whole pipeline,
+and the benchmark reports:
+- jobs per second;
+- the mean number of jobs running at once;
+- core utilisation: the CPU time of the jobs and the orchestrator over the wall time, divided by
+  the cores the run could use;
+- the CPU time of the orchestrator itself.
+
+Stub runtimes are set with the STUB_*_SECONDS variables described in each stub. They sleep by
+default, so the numbers measure scheduling overhead; with --busy they burn CPU instead.
+
+Usage:
+    python benchmark.py [--structures 32] [--workers 1 2 4 8 16 32 64] [--busy] [--output benchmark.csv]
+                        [--keep DIR] [--extra "--warm --pin"]
+'''
+
+import os
+import csv
+import sys
+import time
+import shlex
+import shutil
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+STUB_DIR = HERE / "stub_tools"
+CALCULATIONS = HERE / "calculations.py"
+WORKER_COUNTS = [1, 2, 4, 8, 16, 32, 64]
+CRYSTAL_NAME = "izijoq"  # Matches CRYSTAL_NAME in calculations.py
+
+RES_TEMPLATE = """TITL {name}
+CELL 0.71073 7.1000 9.2000 11.3000 90.000 101.500 90.000
+ZERR 4 0.0010 0.0010 0.0010 0.000 0.010 0.000
+LATT 1
+SYMM -X,1/2+Y,1/2-Z
+SFAC C H N O
+UNIT 24 16 8 4
+C1 1 0.1234 0.2345 0.3456 11.0 0.05
+C2 1 0.2234 0.3345 0.4456 11.0 0.05
+N1 3 0.3234 0.1345 0.2456 11.0 0.05
+O1 4 0.4234 0.4345 0.1456 11.0 0.05
+H1 2 0.5234 0.2345 0.3456 11.0 0.08
+H2 2 0.6234 0.3345 0.2456 11.0 0.08
+HKLF 4
+END
+"""
+
+def make_tree(work_dir, structures):
+    """Lay out the inputs calculations.py expects, with synthetic structures."""
+    root = work_dir / "structure-files"
+    root.mkdir(parents=True)
+    for i in range(structures):
+        name = f"{CRYSTAL_NAME}-{i + 1}"
+        (root / f"{name}.res").write_text(RES_TEMPLATE.format(name=name))
+    dma_dir = work_dir / "all-mults-mols-xyzs-files"
+    dma_dir.mkdir()
+    (dma_dir / f"{CRYSTAL_NAME}.dma").write_text("! Stand-in multipoles\n")
+    (dma_dir / f"{CRYSTAL_NAME}.mols").write_text("! Stand-in molecule axes\n")
+    (work_dir / "bondlengths").write_text("C H 1.08\nN H 1.01\nO H 0.97\n")
+    (work_dir / "fit.pots").write_text("! Stand-in potential\n")
+    for script in ["AutoLD.py", "AutoFree.py"]:
+        shutil.copy2(STUB_DIR / script, work_dir / script)
+
+def run_once(work_dir, workers, extra_args, env):
+    """Run calculations.py over work_dir and return its wall time and rusage."""
+    start = time.monotonic()
+    with open(work_dir / "calculations.log", "w") as log:
+        process = subprocess.Popen([sys.executable, str(CALCULATIONS), "--workers", str(workers)] + extra_args,
+                                   cwd=work_dir, stdout=log, stderr=subprocess.STDOUT, env=env)
+        _, wait_status, usage = os.wait4(process.pid, 0)
+    wall = time.monotonic() - start
+    process.returncode = os.waitstatus_to_exitcode(wait_status)
+    if process.returncode != 0:
+        print(f"calculations.py exited with {process.returncode}, see {work_dir / 'calculations.log'}")
+    return wall, usage
+
+def job_totals(work_dir):
+    """Count the jobs in the resource log with their summed wall and CPU time."""
+    jobs, job_wall, job_cpu = 0, 0.0, 0.0
+    with open(work_dir / "structure-files" / "job-resources.csv", "r", newline="") as f:
+        for row in csv.DictReader(f):
+            jobs += 1
+            job_wall += float(row["wall_s"] or 0)
+            job_cpu += float(row["user_s"] or 0) + float(row["sys_s"] or 0)
+    return jobs, job_wall, job_cpu
+
+def benchmark(structures, worker_counts, busy=False, extra_args=(), keep=None, output=None):
+    env = dict(os.environ)
+    env["PATH"] = f"{STUB_DIR}{os.pathsep}{env.get('PATH', '')}"
+    env["STUB_BUSY"] = "1" if busy else "0"
+    cores = len(os.sched_getaffinity(0))
+    rows = []
+    print(f"{structures} structures, {cores} cores, stubs {'busy' if busy else 'sleeping'}")
+    print(f"{'workers':>7} {'jobs':>6} {'wall s':>8} {'jobs/s':>8} {'running':>8} {'cores used':>10} {'orch cpu s':>10}")
+    for workers in worker_counts:
+        work_dir = Path(tempfile.mkdtemp(prefix=f"benchmark-{workers}.", dir=keep))
+        make_tree(work_dir, structures)
+        wall, usage = run_once(work_dir, workers, list(extra_args), env)
+        jobs, job_wall, job_cpu = job_totals(work_dir)
+        total_cpu = usage.ru_utime + usage.ru_stime
+        row = {
+            "workers": workers,
+            "jobs": jobs,
+            "wall_s": round(wall, 3),
+            "jobs_per_s": round(jobs / wall, 3),
+            "mean_running": round(job_wall / wall, 3),
+            "core_utilisation": round(total_cpu / (wall * min(workers, cores)), 3),
+            "orchestrator_cpu_s": round(max(total_cpu - job_cpu, 0.0), 3),
+        }
+        rows.append(row)
+        print(f"{workers:>7} {jobs:>6} {row['wall_s']:>8.2f} {row['jobs_per_s']:>8.2f} "
+              f"{row['mean_running']:>8.2f} {row['core_utilisation']:>10.2f} {row['orchestrator_cpu_s']:>10.2f}")
+        if keep is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    if output:
+        with open(output, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f"Results written to {output}")
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark calculations.py against the stand-in tools.")
+    parser.add_argument("--structures", type=int, default=32,
+                        help="synthetic structures per run")
+    parser.add_argument("--workers", type=int, nargs="+", default=WORKER_COUNTS,
+                        help="worker counts to benchmark")
+    parser.add_argument("--busy", action="store_true",
+                        help="make the stand-ins burn CPU instead of sleeping")
+    parser.add_argument("--extra", default="",
+                        help="further calculations.py arguments, e.g. \"--warm --pin\"")
+    parser.add_argument("--keep", default=None,
+                        help="keep each run's tree in this directory")
+    parser.add_argument("--output", default=None,
+                        help="write the results to this CSV file")
+    args = parser.parse_args()
+    benchmark(args.structures, args.workers, args.busy, shlex.split(args.extra), args.keep, args.output)
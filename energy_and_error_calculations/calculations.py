@@ -1,7 +1,26 @@
 import os
+import csv
+import json
+import time
+import stat
 import shutil
-import subprocess
+import hashlib
+import asyncio
+import statistics
+import tempfile
+import argparse
+from fnmatch import fnmatch
 from pathlib import Path
+from contextlib import asynccontextmanager
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from job_runner import (run_job, run_job_sync, run_script_job, preload_imports, core_sets, thread_env,
+                        MemoryGate, PrioritySlots)
+from dmacrys_cache import CACHE_LOG, cache_key, cached_output, cached_cpu_seconds, store_output, materialize_output
+from output_compression import (open_output, compressed_format, plain_name, decompress_file, compress_outputs,
+                                is_complete)
+from job_daemon import DAEMON_SOCKET as DEFAULT_DAEMON_SOCKET, run_on_daemon, run_on_daemon_sync, daemon_status
 
 # Define the root directory containing your folders
 ROOT_DIR = "structure-files"
@@ -15,50 +34,166 @@ SCRIPTS_TO_COPY = [
     "AutoFree.py",
     "AutoLD.py",
 ]
+INPUT_STORE = "input-store"  # Content-addressed inputs linked into every structure folder
+WORKERS = 1  # Number of worker processes per stage, overridden by --workers
+JOB_TIMEOUT = None  # Seconds before an external tool is killed, overridden by --timeout
+WARM_SCRIPTS = False  # Run AutoLD/AutoFree inside warm pool workers, overridden by --warm
+SCRIPT_STEPS = ["autold", "autofree"]
+
+# Node-local scratch for dmacrys runs (e.g. /dev/shm or $TMPDIR), overridden by --scratch
+SCRATCH_DIR = None
+SCRATCH_INPUTS = ["bondlengths", "fit.pots", "*.dma", "*.mols"]  # Copied in next to the .dmain
+DMACRYS_CACHE = None  # Set to a directory to reuse the .dmaout of identical dmacrys inputs
+PIN_CPUS = False  # Pin each concurrent job to its own set of cores
+NUMA_NODE = None  # With PIN_CPUS, only use the cores of this NUMA node
+THREADS_PER_JOB = None  # OpenMP/BLAS threads per job, by default the size of its core set
+MEMORY_FRACTION = None  # Admit jobs only while their projected memory fits in this share of MemAvailable
+MEMORY_STEPS = ["dmacrys", "autofree"]  # Steps whose jobs are large enough to need admitting
+ESTIMATE_BASE_KB = 200 * 1024  # Projected peak RSS of a job with no history: a base amount
+ESTIMATE_KB_PER_ATOM = 4 * 1024  # plus this much per atom in the unit cell
+SPECULATE = False  # Race a duplicate against straggling dmacrys jobs once slots sit idle, set by --speculate
+SPECULATE_FACTOR = 3.0  # A job straggles once it has run this many times its predicted Total run time
+SPECULATE_MIN_SECONDS = 60  # and at least this many seconds
+SPECULATE_POLL = 5  # Seconds between checks of a running job for straggling
+DAEMON_SOCKET = None  # Hand every job to the job daemon listening on this socket, set by --daemon
+TIMEOUT_LOG = "timeouts.csv"  # Killed jobs, written next to the structure folders
+RESOURCE_LOG = "job-resources.csv"  # Wall, CPU and peak RSS of every job, next to the folders
+K_SPACING = "0.12"  # k-point spacing passed to AutoLD.py -k
+K_FOLDER_PREFIX = "k_value_"  # Folders named k_value_X run AutoLD.py with -k X instead
+
+# Failed jobs are retried with backoff, then their structure is quarantined
+MAX_ATTEMPTS = 3  # Attempts per job, overridden by --retries
+RETRY_BACKOFF = 30  # Seconds before the first retry, doubled for each further one
+RETRY_FAILURES = ["launch-error", "nonzero-exit", "empty-output"]  # Failures worth retrying
+QUARANTINE_NAME = "quarantine.json"  # Written into a structure folder that keeps failing
+
+# Per-structure completion manifest, written into each structure folder
+STRUCTURES_CSV = "structures.csv"  # Static energies of a molecule, next to its structure folder root
+INTERLEAVE_MOLECULES = False  # Alternate between molecules by energy rank instead of one after another
+ENERGY_WINDOW = None  # Only run structures this many kJ/mol above the lowest static energy
+TOP_N = None  # Only run this many of the lowest static energies
+RANKINGS_DIR = "rankings"  # Ranking CSVs whose free energy spread can set ENERGY_WINDOW
+WINDOW_MARGIN = 1.5  # A derived window is this multiple of the largest free energy spread
+RUN_MANIFEST = "run-manifest.json"  # Pre-filter settings and skip list, next to the structure folders
+REFINE_K_SPACING = None  # Rerun the structures near a rank boundary at this finer spacing, set by --refine-k
+REFINE_MARGIN = 1.0  # kJ/mol either side of a rank boundary within which structures are rerun
+REFINE_TOP_N = None  # Rank boundary between the top N structures and the rest
+OBSERVED_STRUCTURES = []  # Structure ids whose rank is of interest, each a rank boundary
+REFINED_RANKING = "structures-refined-ranking.csv"  # Final ranking, next to the structure folders
 
-def organize_res_files(target_dir):
-    """Organize .res files into folders."""
-    os.chdir(target_dir)
-    for filename in os.listdir():
+# Settings overridden from the command line, handed to the run_stage pool workers explicitly,
+# as workers started by spawn or forkserver import this module afresh with the defaults
+CLI_SETTINGS = ["WORKERS", "JOB_TIMEOUT", "WARM_SCRIPTS", "SCRATCH_DIR", "DMACRYS_CACHE", "PIN_CPUS",
+                "NUMA_NODE", "THREADS_PER_JOB", "MEMORY_FRACTION", "SPECULATE", "SPECULATE_FACTOR",
+                "DAEMON_SOCKET", "INTERLEAVE_MOLECULES", "ENERGY_WINDOW", "TOP_N", "K_SPACING",
+                "REFINE_K_SPACING", "REFINE_MARGIN", "REFINE_TOP_N", "OBSERVED_STRUCTURES", "MAX_ATTEMPTS"]
+MANIFEST_NAME = "manifest.json"
+PIPELINE_STEPS = ["neighcrys", "spli", "autold", "dmacrys", "autofree"]
+K_FOLDER_SKIP = [MANIFEST_NAME, QUARANTINE_NAME, "neighcrys.log", "autold.log",
+                 "*.res_*", "*.out"]  # Files of a finished folder not carried into its k folders
+
+def organize_res_files(target_dir, skip=()):
+    """Organize .res files into folders, leaving the structures in skip where they are."""
+    for filename in os.listdir(target_dir):
         if filename.endswith('.res'):
             base_name = os.path.splitext(filename)[0]
-            os.makedirs(base_name, exist_ok=True)
-            shutil.move(filename, os.path.join(base_name, filename))
+            if base_name in skip:
+                continue
+            os.makedirs(os.path.join(target_dir, base_name), exist_ok=True)
+            shutil.move(os.path.join(target_dir, filename), os.path.join(target_dir, base_name, filename))
     print("All .res files have been organized into their respective folders.")
 
-def organize_crystal_files(target_dir):
-    """Copy required files into each .res folder."""
-    dma_file = os.path.join(DMA_SOURCE_DIR, f"{CRYSTAL_NAME}.dma")
-    mols_file = os.path.join(DMA_SOURCE_DIR, f"{CRYSTAL_NAME}.mols")
+def file_hash(path):
+    """Return the SHA-256 hex digest of a file."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def store_input(path, store_dir=INPUT_STORE):
+    """Add a file to the input store under its content hash and return the stored path.
+
+    Stored files are made read-only, as every structure folder shares them.
+    """
+    digest = file_hash(path)
+    stored = Path(store_dir) / digest
+    if stored.exists() and file_hash(stored) == digest:
+        return stored
+    os.makedirs(store_dir, exist_ok=True)
+    tmp_path = stored.with_suffix(f".{os.getpid()}.tmp")
+    shutil.copy2(path, tmp_path)
+    os.chmod(tmp_path, stat.S_IMODE(os.stat(tmp_path).st_mode) & ~0o222)
+    os.replace(tmp_path, stored)
+    return stored
+
+def link_input(stored, destination):
+    """Place a stored input at destination as a hardlink, a symlink or a verified copy.
+
+    Returns how the file was placed, or "present" if it was already there.
+    """
+    destination = Path(destination)
+    if destination.exists():
+        if os.path.samefile(stored, destination):
+            return "present"
+        if not destination.is_symlink() and file_hash(destination) == stored.name:
+            return "present"
+    tmp_path = destination.with_name(f".{destination.name}.tmp")
+    if tmp_path.exists() or tmp_path.is_symlink():
+        tmp_path.unlink()
+    try:
+        os.link(stored, tmp_path)
+        method = "hardlink"
+    except OSError:
+        try:
+            os.symlink(os.path.abspath(stored), tmp_path)
+            method = "symlink"
+        except OSError:
+            shutil.copy2(stored, tmp_path)
+            if file_hash(tmp_path) != stored.name:
+                tmp_path.unlink()
+                raise OSError(f"Copy of {stored} at {destination} does not match its hash")
+            method = "copy"
+    os.replace(tmp_path, destination)
+    return method
+
+def stage_inputs(target_dir, inputs):
+    """Link the same named inputs into every folder of target_dir.
+
+    inputs maps the name each folder should see to the source file. Every
+    source is hashed once into INPUT_STORE, so staging a folder costs a link
+    per file rather than a copy.
+    """
+    stored = {name: store_input(path) for name, path in inputs.items()}
+    methods = defaultdict(int)
+    for folder in Path(target_dir).iterdir():
+        if folder.is_dir() and not is_pruned(folder):
+            for name, stored_path in stored.items():
+                methods[link_input(stored_path, folder / name)] += 1
+    return dict(methods)
+
+def organize_crystal_files(target_dir, crystal_name=CRYSTAL_NAME):
+    """Link the required input files into each .res folder."""
+    dma_file = os.path.join(DMA_SOURCE_DIR, f"{crystal_name}.dma")
+    mols_file = os.path.join(DMA_SOURCE_DIR, f"{crystal_name}.mols")
 
     required_files = {
         "bondlengths": BONDLENGTHS_PATH,
         "fit.pots": FITPOTS_PATH,
-        f"{CRYSTAL_NAME}.dma": dma_file,
-        f"{CRYSTAL_NAME}.mols": mols_file
+        f"{crystal_name}.dma": dma_file,
+        f"{crystal_name}.mols": mols_file
     }
 
     for name, path in required_files.items():
         if not os.path.exists(path):
             raise FileNotFoundError(f"Missing required file: {name} at {path}")
 
-    for folder in os.listdir(target_dir):
-        folder_path = os.path.join(target_dir, folder)
-        if os.path.isdir(folder_path):
-            shutil.copy2(BONDLENGTHS_PATH, folder_path)
-            shutil.copy2(FITPOTS_PATH, folder_path)
-            shutil.copy2(dma_file, os.path.join(folder_path, f"{CRYSTAL_NAME}.dma"))
-            shutil.copy2(mols_file, os.path.join(folder_path, f"{CRYSTAL_NAME}.mols"))
-    print(f"All files moved to .res folders for {CRYSTAL_NAME}")
+    methods = stage_inputs(target_dir, required_files)
+    print(f"All files linked into .res folders for {crystal_name}: {methods}")
 
-def create_fort22_files(target_dir):
-    """Create fort.22 files in each folder."""
-    for folder in os.listdir(target_dir):
-        folder_path = os.path.join(target_dir, folder)
-        if os.path.isdir(folder_path):
-            res_filename = folder
-            crystal_name = res_filename.split('-')[0]
-            content = f"""I
+def write_fort22(folder, res_filename, crystal_name):
+    """Write the neighcrys answers for res_filename.res into folder/fort.22."""
+    content = f"""I
 {res_filename}.res
 bondlengths
   4.0000
@@ -75,35 +210,512 @@ n
 y
 fit.pots
 """
-            with open(os.path.join(folder_path, "fort.22"), "w") as f:
-                f.write(content)
+    with open(os.path.join(folder, "fort.22"), "w") as f:
+        f.write(content)
+
+def create_fort22_files(target_dir):
+    """Create fort.22 files in each folder."""
+    for folder in os.listdir(target_dir):
+        folder_path = os.path.join(target_dir, folder)
+        if os.path.isdir(folder_path) and not load_manifest(folder_path):
+            write_fort22(folder_path, folder, folder.split('-')[0])
     print("fort.22 files created in all folders")
 
+def structure_name(folder):
+    """Return the name of the structure a folder holds.
+
+    That is the .res file named in its fort.22, which for structure-files
+    folders is the folder name itself.
+    """
+    try:
+        with open(Path(folder) / "fort.22", "r") as f:
+            lines = f.read().splitlines()
+        if len(lines) > 1 and lines[1].strip().endswith(".res"):
+            return lines[1].strip()[:-len(".res")]
+    except OSError:
+        pass
+    return Path(folder).name
+
+def k_spacing_of(folder):
+    """Return the k-point spacing a folder runs AutoLD.py with."""
+    name = Path(folder).name
+    return name[len(K_FOLDER_PREFIX):] if name.startswith(K_FOLDER_PREFIX) else K_SPACING
+
+def load_static_energies(root_dir):
+    """Read the static energy of each structure id from the structures.csv of a root, if any."""
+    csv_path = Path(root_dir).parent / STRUCTURES_CSV
+    energies = {}
+    try:
+        with open(csv_path, "r", newline="") as f:
+            for row in csv.DictReader(f):
+                try:
+                    energies[row["id"]] = float(row["energy"])
+                except (KeyError, TypeError, ValueError):
+                    pass
+    except OSError:
+        pass
+    return energies
+
+def in_energy_order(folders, root_dir):
+    """Sort structure folders by static energy, lowest first, and those without one by name at the end."""
+    energies = load_static_energies(root_dir)
+    return sorted(folders, key=lambda folder: (energies.get(structure_name(folder), float("inf")),
+                                               folder.name))
+
+def structure_priorities(root_dirs, interleave=INTERLEAVE_MOLECULES):
+    """Give every structure folder its dispatch priority, lower values first.
+
+    Each root is ranked by static energy. Molecules follow one another, or
+    with interleave the best structure of each molecule comes first, then
+    the second best of each, and so on.
+    """
+    priorities = {}
+    for molecule, root_dir in enumerate(root_dirs):
+        folders = [folder for folder in Path(root_dir).iterdir() if folder.is_dir()]
+        for rank, folder in enumerate(in_energy_order(folders, root_dir)):
+            priorities[folder] = (rank, molecule) if interleave else (molecule, rank)
+    return priorities
+
+def free_energy_window(rankings_dir=RANKINGS_DIR, margin=WINDOW_MARGIN):
+    """Derive an energy window from the largest spread of "free energy" in ranking CSVs.
+
+    No structure can overtake one more than that spread below it, so
+    structures further above the minimum cannot reach the top ranks.
+    """
+    spreads = []
+    for csv_path in sorted(Path(rankings_dir).glob("*.csv")):
+        values = []
+        with open(csv_path, "r", newline="") as f:
+            for row in csv.DictReader(f):
+                try:
+                    values.append(float(row["free energy"]))
+                except (KeyError, TypeError, ValueError):
+                    pass  # "N/A" for structures AutoFree did not finish
+        if len(values) > 1:
+            spreads.append(max(values) - min(values))
+    if not spreads:
+        raise FileNotFoundError(f"No free energy values in {rankings_dir}/*.csv")
+    window = margin * max(spreads)
+    print(f"Largest free energy spread in {rankings_dir}: {max(spreads):.2f} kJ/mol, "
+          f"using a {window:.2f} kJ/mol window")
+    return window
+
+def prefilter_structures(root_dir, window=None, top_n=None):
+    """Choose the structures of a root worth phonon calculations and record the rest in RUN_MANIFEST.
+
+    A structure is kept if its static energy is within window kJ/mol of
+    the lowest and among the top_n lowest, whichever of the two are set.
+    Structures missing from structures.csv are always kept. Returns the
+    names of the skipped structures.
+    """
+    energies = load_static_energies(root_dir)
+    ranked = sorted(energies, key=energies.get)
+    skipped = []
+    if ranked:
+        minimum = energies[ranked[0]]
+        skipped = [name for rank, name in enumerate(ranked)
+                   if (window is not None and energies[name] - minimum > window)
+                   or (top_n is not None and rank >= top_n)]
+    manifest = {
+        "energy window": window,
+        "top n": top_n,
+        "minimum energy": energies[ranked[0]] if ranked else None,
+        "skipped": skipped,
+        "filtered at": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    manifest_path = Path(root_dir) / RUN_MANIFEST
+    tmp_path = manifest_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+    if window is not None or top_n is not None:
+        print(f"Pre-filter kept {len(ranked) - len(skipped)} of {len(ranked)} structures, "
+              f"skip list written to {manifest_path}")
+    return set(skipped)
+
+def skipped_structures(root_dir):
+    """Return the structures the pre-filter skipped in a root."""
+    try:
+        with open(Path(root_dir) / RUN_MANIFEST, "r") as f:
+            return set(json.load(f).get("skipped", []))
+    except (OSError, ValueError):
+        return set()
+
+def load_manifest(folder):
+    """Load the completion manifest of a structure folder."""
+    manifest_path = Path(folder) / MANIFEST_NAME
+    if not manifest_path.exists():
+        return {}
+    try:
+        with open(manifest_path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def mark_step_done(folder, step):
+    """Record a finished step in the manifest and forget every later step.
+
+    A finished AutoLD step also records the k-point spacing it ran with, so
+    scripts run later in their own process need not know the run's settings.
+    """
+    manifest = load_manifest(folder)
+    earlier_steps = PIPELINE_STEPS[:PIPELINE_STEPS.index(step)]
+    manifest = {name: stamp for name, stamp in manifest.items()
+                if name in earlier_steps or (name == "k spacing" and "autold" in earlier_steps)}
+    manifest[step] = time.strftime("%Y-%m-%d %H:%M:%S")
+    if step == "autold":
+        manifest["k spacing"] = k_spacing_of(folder)
+    manifest_path = Path(folder) / MANIFEST_NAME
+    tmp_path = manifest_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+def is_step_done(folder, step):
+    """Check the manifest and the files on disk for a finished step."""
+    if step not in load_manifest(folder):
+        return False
+    if step == "neighcrys":
+        return (folder / f"{structure_name(folder)}.res.dmain").exists()
+    if step == "dmacrys":
+        return not any(is_dmain_pending(path) for path in folder.glob("*.dmain"))
+    if step == "autofree":
+        return is_complete(folder / f"{structure_name(folder)}.out")
+    return True
+
+def classify_failure(result, output_file=None, check_complete=False):
+    """Return why a job failed, or None if it succeeded.
+
+    The reasons are "timeout", "launch-error" (the tool could not be
+    started), "nonzero-exit", "empty-output" (output_file missing or empty)
+    and "incomplete-output" (with check_complete, output_file lacks the
+    lines a finished run writes, e.g. the dmacrys timing footer).
+    """
+    if result["status"] == "timeout":
+        return "timeout"
+    if result["returncode"] is None:
+        return "launch-error"
+    if result["returncode"] != 0:
+        return "nonzero-exit"
+    if output_file is not None:
+        if not output_file.exists() or output_file.stat().st_size == 0:
+            return "empty-output"
+        if check_complete and not is_complete(output_file):
+            return "incomplete-output"
+    return None
+
+def failure_status(failure):
+    """Map a failure reason to the status counted in the stage summaries."""
+    if failure is None:
+        return "completed"
+    return "timeout" if failure == "timeout" else "failed"
+
+def should_retry(result, attempt):
+    """Decide whether a failed attempt is worth another try."""
+    return result.get("failure") in RETRY_FAILURES and attempt < MAX_ATTEMPTS
+
+def retry_message(result, attempt):
+    delay = RETRY_BACKOFF * 2 ** (attempt - 1)
+    return delay, (f"Retrying {result['name']} in {delay} s after {result['failure']} "
+                   f"(attempt {attempt} of {MAX_ATTEMPTS})")
+
+def is_quarantined(folder):
+    return (Path(folder) / QUARANTINE_NAME).exists()
+
+def is_pruned(folder):
+    """Check whether retention.py has removed the intermediates of a finished folder."""
+    return "pruned" in load_manifest(folder)
+
+def quarantine(folder, step, result, attempts):
+    """Record a job that kept failing in its structure's quarantine file."""
+    quarantine_path = Path(folder) / QUARANTINE_NAME
+    failures = []
+    if quarantine_path.exists():
+        with open(quarantine_path, "r") as f:
+            failures = json.load(f)
+    failures.append({
+        "step": step,
+        "job": result["name"],
+        "reason": result.get("failure"),
+        "attempts": attempts,
+        "returncode": result["returncode"],
+        "stderr": result["stderr"],
+        "quarantined at": time.strftime("%Y-%m-%d %H:%M:%S"),
+    })
+    with open(quarantine_path, "w") as f:
+        json.dump(failures, f, indent=2)
+    return f"Quarantined {Path(folder).name}: {result['name']} failed {attempts} times ({result.get('failure')})"
+
+def release_quarantine(root_dir):
+    """Remove every quarantine file so those structures are tried again."""
+    released = 0
+    for folder in Path(root_dir).iterdir():
+        if folder.is_dir() and is_quarantined(folder):
+            (folder / QUARANTINE_NAME).unlink()
+            released += 1
+    print(f"Released {released} quarantined structures")
+
+def report_quarantine(root_dir):
+    """Print the structures currently in quarantine and why."""
+    for folder in sorted(Path(root_dir).iterdir()):
+        if folder.is_dir() and is_quarantined(folder):
+            with open(folder / QUARANTINE_NAME, "r") as f:
+                failures = json.load(f)
+            reasons = ", ".join(f"{failure['job']} ({failure['reason']})" for failure in failures)
+            print(f"Quarantined: {folder.name}: {reasons}")
+
+def is_skipped(folder, skipped=None):
+    """Check whether the pre-filter skipped a structure.
+
+    skipped is the skipped_structures of the folder's root, read here if
+    not given; callers checking many folders read it once and pass it in.
+    """
+    if skipped is None:
+        skipped = skipped_structures(Path(folder).parent)
+    return bool(skipped) and structure_name(folder) in skipped
+
+def next_step(folder, skipped=None):
+    """Return the first step still to run for a structure folder, or None.
+
+    Quarantined structures have nothing to run until they are released,
+    and structures the pre-filter skipped or that have been pruned since
+    finishing have nothing to run at all. skipped is passed on to is_skipped.
+    """
+    if is_quarantined(folder) or is_skipped(folder, skipped) or is_pruned(folder):
+        return None
+    for step in PIPELINE_STEPS:
+        if not is_step_done(folder, step):
+            return step
+    return None
+
+def start_stage_worker(settings):
+    """Set up a run_stage pool worker with the orchestrator's settings."""
+    globals().update(settings)
+    if WARM_SCRIPTS:
+        preload_imports()
+
+def run_stage(stage_name, worker, items, workers=None):
+    """Apply worker to every item, serially or across a process pool.
+
+    Each worker returns a (name, status, log) tuple. Logs are printed in item
+    order either way, so the pool output matches the serial output.
+    """
+    workers = workers or WORKERS
+    if workers > 1 or WARM_SCRIPTS:
+        settings = {name: globals()[name] for name in CLI_SETTINGS}
+        with ProcessPoolExecutor(max_workers=workers, initializer=start_stage_worker,
+                                 initargs=(settings,)) as pool:
+            results = pool.map(worker, items)
+            results = [report_result(result) for result in results]
+    else:
+        results = [report_result(worker(item)) for item in items]
+
+    counts = {"completed": 0, "skipped": 0, "failed": 0, "timeout": 0}
+    for _, status, _ in results:
+        counts[status] += 1
+    print(f"{stage_name} summary: {counts['completed']} completed, "
+          f"{counts['skipped']} skipped, {counts['failed']} failed, "
+          f"{counts['timeout']} timed out")
+    return results
+
+def report_result(result):
+    """Print the log of a finished folder and pass the result through."""
+    if result[2]:
+        print(result[2])
+    return result
+
+def check_inputs(folder, step):
+    """Return a skip message if the inputs of a folder step are missing."""
+    if not folder.is_dir():
+        return f"Skipping {folder.name}: Not a directory"
+    required = {"neighcrys": "fort.22", "autold": "AutoLD.py", "autofree": "AutoFree.py"}.get(step)
+    if required and not (folder / required).exists():
+        return f"Skipping {folder.name}: {required} not found"
+    return None
+
+def append_csv_row(path, header, row):
+    """Append one row to a CSV log shared by concurrent workers, writing the header first if new."""
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND, 0o644)
+        os.write(fd, (",".join(header) + "\n").encode())
+    except FileExistsError:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+    try:
+        # A single short write to an O_APPEND file is not interleaved with others
+        os.write(fd, (",".join(str(value) for value in row) + "\n").encode())
+    finally:
+        os.close(fd)
+
+def displacement_of(job_name):
+    """Return the displacement label of a displaced .dmain/.dmaout name, '' if undisplaced."""
+    if ".res_" not in job_name:
+        return ""
+    return job_name.split(".res_")[1].split(".")[0]
+
+def record_resources(folder, step, result):
+    """Log the wall time, CPU time and peak RSS of a finished job to RESOURCE_LOG."""
+    def number(value, digits):
+        return "" if value is None else f"{value:.{digits}f}"
+
+    append_csv_row(
+        folder.parent / RESOURCE_LOG,
+        ["structure", "step", "k_spacing", "displacement", "job", "status", "returncode",
+         "wall_s", "user_s", "sys_s", "max_rss_kb", "finished at"],
+        [structure_name(folder), step, k_spacing_of(folder), displacement_of(result["name"]) if step == "dmacrys" else "",
+         result["name"], result["status"], "" if result["returncode"] is None else result["returncode"],
+         number(result["wall"], 3), number(result.get("user"), 3), number(result.get("sys"), 3),
+         result.get("max_rss_kb") or "", time.strftime("%Y-%m-%d %H:%M:%S")],
+    )
+
+# Lattice points per cell for the SHELX LATT codes P, I, R, F, A, B and C
+LATTICE_POINTS = {1: 1, 2: 2, 3: 3, 4: 4, 5: 2, 6: 2, 7: 2}
+RES_KEYWORDS = {"TITL", "CELL", "ZERR", "LATT", "SYMM", "SFAC", "UNIT", "DISP", "FVAR", "REM",
+                "WGHT", "PLAN", "L.S.", "BOND", "CONF", "HTAB", "AFIX", "HKLF", "END"}
+
+def count_cell_atoms(res_file):
+    """Count the atoms in the unit cell of a SHELX .res file, or return None if unreadable.
+
+    The atoms listed are multiplied by the SYMM operators, the inversion
+    centre of a positive LATT and the lattice centring.
+    """
+    atoms, operators, latt = 0, 1, 1
+    try:
+        with open(res_file, "r") as f:
+            for line in f:
+                words = line.split()
+                if not words:
+                    continue
+                keyword = words[0].upper()
+                if keyword in ("END", "HKLF"):
+                    break
+                if keyword == "LATT":
+                    latt = int(words[1])
+                elif keyword == "SYMM":
+                    operators += 1
+                elif keyword not in RES_KEYWORDS and len(words) >= 5 and words[1].isdigit():
+                    atoms += 1
+    except (OSError, ValueError, IndexError):
+        return None
+    return atoms * operators * (2 if latt > 0 else 1) * LATTICE_POINTS.get(abs(latt), 1) or None
+
+def load_peak_rss(root_dir, run):
+    """Read the peak RSS of earlier jobs below root_dir into the run's memory history."""
+    root_dir = Path(root_dir)
+    run.history_roots.add(root_dir)
+    try:
+        with open(root_dir / RESOURCE_LOG, "r", newline="") as f:
+            rows = list(csv.DictReader(f))
+    except OSError:
+        return
+    for row in rows:
+        if row["max_rss_kb"]:
+            res_files = list(root_dir.glob(f"*/{row['structure']}.res"))
+            atoms = count_cell_atoms(res_files[0]) if res_files else None
+            remember_peak(row["structure"], row["step"], int(row["max_rss_kb"]), atoms, run)
+
+def remember_peak(structure, step, max_rss_kb, atoms, run):
+    """Keep the largest peak RSS seen per structure and step, and per cell atom for each step."""
+    key = (structure, step)
+    run.peak_rss[key] = max(run.peak_rss.get(key, 0), max_rss_kb)
+    if atoms:
+        run.kb_per_atom[step] = max(run.kb_per_atom.get(step, 0), max_rss_kb / atoms)
+
+def projected_memory_kb(folder, step, run):
+    """Project the peak RSS of a job from its own history, that of structures of similar size, or an estimate.
+
+    A structure that has run this step before is expected to need its
+    largest peak again. Otherwise the largest peak per cell atom seen for
+    the step is scaled to the structure's cell, and with no history at all
+    ESTIMATE_BASE_KB plus ESTIMATE_KB_PER_ATOM per cell atom is assumed.
+    """
+    if folder.parent not in run.history_roots:
+        load_peak_rss(folder.parent, run)
+    name = structure_name(folder)
+    if (name, step) in run.peak_rss:
+        return run.peak_rss[(name, step)]
+    atoms = count_cell_atoms(folder / f"{name}.res") or 0
+    if step in run.kb_per_atom and atoms:
+        return int(run.kb_per_atom[step] * atoms)
+    return ESTIMATE_BASE_KB + ESTIMATE_KB_PER_ATOM * atoms
+
+def learn_peak(folder, step, result, run):
+    if run.memory is not None and result.get("max_rss_kb"):
+        name = structure_name(folder)
+        remember_peak(name, step, result["max_rss_kb"], count_cell_atoms(folder / f"{name}.res"), run)
+
+@asynccontextmanager
+async def memory_admission(folder, step, run, priority=None):
+    """Hold back a job of a MEMORY_STEPS step until its projected memory fits.
+
+    Enter it before taking the job's slot, so a job waiting for memory
+    leaves its slot to jobs that can run. Waiting jobs are considered in
+    structure priority order, by default that of folder, and smaller jobs
+    backfill around ones that do not fit yet.
+    """
+    if run.memory is None or step not in MEMORY_STEPS:
+        yield
+        return
+    need_kb = projected_memory_kb(folder, step, run)
+    await run.memory.admit(need_kb, priority or run.priority_of(folder))
+    try:
+        yield
+    finally:
+        await run.memory.release(need_kb)
+
+def job_log(folder, step, result):
+    """Describe a failed or killed job and record what it cost.
+
+    Every job goes to RESOURCE_LOG and killed jobs also go to TIMEOUT_LOG.
+    """
+    record_resources(folder, step, result)
+    log = []
+    if result["status"] == "timeout":
+        log.append(f"Killed {result['name']} after {result['wall']:.0f} s")
+        append_csv_row(folder.parent / TIMEOUT_LOG, ["structure", "job", "seconds", "killed at"],
+                       [structure_name(folder), result["name"], f"{result['wall']:.1f}",
+                        time.strftime("%Y-%m-%d %H:%M:%S")])
+    if result["stderr"]:
+        log.append(f"Errors from {result['name']}:\n{result['stderr']}")
+    return log
+
+def neighcrys_command(folder):
+    """Describe a neighcrys run on the fort.22 file in one folder."""
+    return {
+        "name": folder.name,
+        "args": ["neighcrys", "fort.22"],
+        "cwd": str(folder),
+        "input": "\n\n",
+        "stdout": str(folder / "neighcrys.log"),
+    }
+
+def neighcrys_outcome(folder, result):
+    """Check a finished neighcrys run."""
+    log = [f"Processing: {folder.name}"]
+    result["failure"] = classify_failure(result, folder / f"{structure_name(folder)}.res.dmain")
+    if result["failure"] is None:
+        log.append(f"Completed: {folder.name}, output saved to {folder / 'neighcrys.log'}")
+    elif result["failure"] == "empty-output":
+        log.append(f"Warning: No .dmain file created in {folder.name}")
+    log.extend(job_log(folder, "neighcrys", result))
+    return folder.name, failure_status(result["failure"]), "\n".join(log)
+
+def neighcrys_folder(folder):
+    """Run neighcrys on the fort.22 file in one folder."""
+    return run_folder_step(folder, "neighcrys")
+
+def record_stage(root_dir, step, results):
+    """Mark the folders that completed a stage in their manifests."""
+    for name, status, _ in results:
+        if status == "completed":
+            mark_step_done(Path(root_dir) / name, step)
+
 def process_folders(root_dir):
     """Run neighcrys on each fort.22 file."""
-    for folder in Path(root_dir).iterdir():
-        if folder.is_dir():
-            fort22_path = folder / "fort.22"
-            if fort22_path.exists():
-                print(f"Processing: {folder.name}")
-                try:
-                    process = subprocess.Popen(
-                        ["neighcrys", "fort.22"],
-                        stdin=subprocess.PIPE,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        text=True,
-                        cwd=folder
-                    )
-                    stdout, stderr = process.communicate(input="\n\n")
-                    print(f"Completed: {folder.name}\n{stdout}")
-                    dmain_file = folder / f"{folder.name}.res.dmain"
-                    if not dmain_file.exists():
-                        print(f"Warning: No .dmain file created in {folder.name}")
-                except subprocess.CalledProcessError as e:
-                    print(f"Error in {folder.name}:\n{e.stderr}")
-            else:
-                print(f"Skipping {folder.name}: fort.22 not found")
+    skipped = skipped_structures(root_dir)
+    folders = [folder for folder in Path(root_dir).iterdir()
+               if folder.is_dir() and next_step(folder, skipped) == "neighcrys"]
+    folders = in_energy_order(folders, root_dir)
+    record_stage(root_dir, "neighcrys", run_stage("NEIGHCRYS", neighcrys_folder, folders))
     print("All folders processed")
 
 def remove_spli_lines(file_path):
@@ -120,157 +732,948 @@ def remove_spli_lines(file_path):
 
 def process_dmain_files(root_dir):
     """Remove 'SPLI' lines from all .res.dmain files."""
+    skipped = skipped_structures(root_dir)
     for folder in Path(root_dir).iterdir():
         if folder.is_dir():
-            dmain_file = folder / f"{folder.name}.res.dmain"
-            if dmain_file.exists():
+            dmain_file = folder / f"{structure_name(folder)}.res.dmain"
+            if next_step(folder, skipped) != "spli":
+                print(f"Skipping {folder.name}: SPLI lines already removed or neighcrys not finished")
+            elif dmain_file.exists():
                 remove_spli_lines(dmain_file)
+                mark_step_done(folder, "spli")
             else:
                 print(f"Skipping {folder.name}: .res.dmain file not found")
     print("All .res.dmain files processed")
 
 def copy_scripts_to_folders(root_dir, scripts):
-    """Copy scripts into each folder."""
-    for folder in Path(root_dir).iterdir():
-        if folder.is_dir():
-            print(f"Copying scripts to: {folder.name}")
-            for script in scripts:
-                try:
-                    shutil.copy(script, folder)
-                    print(f"Copied {Path(script).name} to {folder.name}")
-                except Exception as e:
-                    print(f"Error copying {Path(script).name} to {folder.name}: {e}")
-        else:
-            print(f"Skipping {folder.name}: Not a directory")
-    print("Script copying completed")
+    """Link scripts into each folder through the input store."""
+    for script in scripts:
+        if not os.path.exists(script):
+            print(f"Error staging {Path(script).name}: not found at {script}")
+            return
+    methods = stage_inputs(root_dir, {Path(script).name: script for script in scripts})
+    print(f"Script staging completed: {methods}")
+
+def autold_command(folder):
+    """Describe an AutoLD.py run in one folder."""
+    return {
+        "name": folder.name,
+        "args": ["python", "AutoLD.py", "-k", k_spacing_of(folder)],
+        "cwd": str(folder),
+        "stdout": str(folder / "autold.log"),
+    }
+
+def autold_outcome(folder, result):
+    """Check a finished AutoLD.py run."""
+    log = [f"Running AutoLD.py in: {folder.name}"]
+    result["failure"] = classify_failure(result)
+    log.extend(job_log(folder, "autold", result))
+    return folder.name, failure_status(result["failure"]), "\n".join(log)
+
+def autold_folder(folder):
+    """Run AutoLD.py in one folder."""
+    return run_folder_step(folder, "autold")
 
 def run_autold_in_folders(root_dir):
     """Run AutoLD.py in each folder."""
-    for folder in Path(root_dir).iterdir():
-        if folder.is_dir():
-            autold_script = folder / "AutoLD.py"
-            if autold_script.exists():
-                print(f"Running AutoLD.py in: {folder.name}")
-                try:
-                    result = subprocess.run(
-                        ["python", str(autold_script), "-k", "0.12"],
-                        cwd=folder,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        text=True
-                    )
-                    if result.stdout:
-                        print(f"Output from {folder.name}:\n{result.stdout}")
-                    if result.stderr:
-                        print(f"Errors from {folder.name}:\n{result.stderr}")
-                except Exception as e:
-                    print(f"Error running AutoLD.py in {folder.name}: {e}")
-            else:
-                print(f"Skipping {folder.name}: AutoLD.py not found")
-        else:
-            print(f"Skipping {folder.name}: Not a directory")
+    skipped = skipped_structures(root_dir)
+    folders = [folder for folder in Path(root_dir).iterdir()
+               if folder.is_dir() and next_step(folder, skipped) == "autold"]
+    folders = in_energy_order(folders, root_dir)
+    record_stage(root_dir, "autold", run_stage("AutoLD", autold_folder, folders))
     print("AutoLD.py execution completed")
 
-def run_dmacrys_on_dmain(root_dir):
-    """Run dmacrys2.2.1 on each .dmain file."""
+def dmacrys_command(dmain_file, run_dir=None):
+    """Describe a dmacrys2.2.1 run on a single .dmain file, in run_dir if given."""
+    run_dir = Path(run_dir or dmain_file.parent)
+    return {
+        "name": dmain_file.name,
+        "args": ["dmacrys2.2.1"],
+        "cwd": str(run_dir),
+        "stdin": str(run_dir / dmain_file.name),
+        "stdout": str(run_dir / dmain_file.with_suffix(".dmaout").name),
+        "env": thread_env(THREADS_PER_JOB) if THREADS_PER_JOB else None,
+    }
+
+def dmacrys_outcome(dmain_file, result):
+    """Check a finished dmacrys2.2.1 run."""
+    output_file = dmain_file.with_suffix(".dmaout")
+    log = [f"\nRunning dmacrys2.2.1 on: {dmain_file}", f"Output saved to: {output_file}"]
+    result["failure"] = classify_failure(result, output_file, check_complete=True)
+    if result["failure"] == "incomplete-output":
+        log.append(f"Warning: {output_file} has no 'Total run time' footer")
+    log.extend(job_log(dmain_file.parent, "dmacrys", result))
+    return dmain_file.name, failure_status(result["failure"]), "\n".join(log)
+
+def stage_in(dmain_file, scratch_dir=None):
+    """Copy a .dmain file and the inputs dmacrys reads into a fresh directory under scratch_dir or SCRATCH_DIR."""
+    scratch_dir = scratch_dir or SCRATCH_DIR
+    os.makedirs(scratch_dir, exist_ok=True)
+    scratch = Path(tempfile.mkdtemp(prefix=f"{dmain_file.stem}.", dir=scratch_dir))
+    shutil.copy2(dmain_file, scratch)
+    for pattern in SCRATCH_INPUTS:
+        for path in dmain_file.parent.glob(pattern):
+            shutil.copy2(path, scratch)
+    return scratch
+
+def stage_out(dmain_file, scratch):
+    """Copy everything dmacrys wrote back to the structure folder and drop the scratch.
+
+    AutoFree reads more than the .dmaout, such as the fort.* files, so every
+    file but the staged inputs goes back, as if dmacrys had run in place.
+    The .dmaout goes last, so a complete one means the rest are back too.
+    """
+    try:
+        staged = {dmain_file.name} | {path.name for pattern in SCRATCH_INPUTS for path in scratch.glob(pattern)}
+        outputs = [path for path in scratch.iterdir() if path.is_file() and path.name not in staged]
+        for path in sorted(outputs, key=lambda path: path.suffix == ".dmaout"):
+            tmp_path = dmain_file.parent / f".{path.name}.tmp"
+            shutil.copy2(path, tmp_path)
+            os.replace(tmp_path, dmain_file.parent / path.name)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+def is_dmain_pending(dmain_file):
+    """Return True if the .dmain file has no finished .dmaout next to it."""
+    return not is_complete(dmain_file.with_suffix(".dmaout"))
+
+def collect_dmain_queue(root_dir):
+    """Collect the pending .dmain files of every folder due for dmacrys into one flat queue, lowest static energy first.
+
+    Quarantined, skipped and pruned folders, and folders whose AutoLD has not
+    finished, are left out, as next_step decides for the task graph.
+    """
+    energies = load_static_energies(root_dir)
+    skipped = skipped_structures(root_dir)
+    folders = [folder for folder in Path(root_dir).iterdir()
+               if folder.is_dir() and next_step(folder, skipped) == "dmacrys"]
+    queue = sorted((path for folder in folders for path in folder.glob("*.dmain") if is_dmain_pending(path)),
+                   key=lambda path: (energies.get(structure_name(path.parent), float("inf")), path))
+    print(f"Queued {len(queue)} pending .dmain files from {root_dir}")
+    return queue
+
+async def run_dmacrys_queue(queue, workers):
+    """Run a flat queue of .dmain files in queue order, at most workers at a time."""
+    run = PipelineRun(workers)
+    for rank, dmain_file in enumerate(queue):
+        run.priority.setdefault(dmain_file.parent, (rank,))
+    await asyncio.gather(*(run_dmacrys_job(dmain_file, run) for dmain_file in queue))
+    report_cache(run)
+    report_speculation(run)
+    return run.counts["dmacrys"]
+
+def run_dmacrys_on_dmain(root_dir, workers=None):
+    """Run dmacrys2.2.1 on every pending .dmain file below root_dir."""
+    counts = asyncio.run(run_dmacrys_queue(collect_dmain_queue(root_dir), workers or WORKERS))
+    print(f"DMACRYS summary: {counts['completed']} completed, "
+          f"{counts['skipped']} skipped, {counts['failed']} failed, "
+          f"{counts['timeout']} timed out")
+    skipped = skipped_structures(root_dir)
     for folder in Path(root_dir).iterdir():
-        if folder.is_dir():
-            print(f"\nProcessing folder: {folder.name}")
-            dmain_files = list(folder.glob("*.dmain"))
-            if not dmain_files:
-                print(f"No .dmain files found in {folder.name}")
-                continue
-            for dmain_file in dmain_files:
-                output_file = dmain_file.with_suffix(".dmaout")
-                print(f"\nRunning dmacrys2.2.1 on: {dmain_file}")
-                try:
-                    with open(dmain_file, "r") as infile, open(output_file, "w") as outfile:
-                        result = subprocess.run(
-                            ["dmacrys2.2.1"],
-                            stdin=infile,
-                            stdout=outfile,
-                            stderr=subprocess.PIPE,
-                            text=True
-                        )
-                    print(f"Output saved to: {output_file}")
-                    if result.stderr:
-                        print(f"Errors from {dmain_file}:\n{result.stderr}")
-                except Exception as e:
-                    print(f"Error processing {dmain_file}: {e}")
-        else:
-            print(f"Skipping {folder.name}: Not a directory")
+        if (folder.is_dir() and next_step(folder, skipped) == "dmacrys"
+                and not any(map(is_dmain_pending, folder.glob("*.dmain")))):
+            mark_step_done(folder, "dmacrys")
     print("\nDMACRYS processing completed")
 
+def autofree_command(folder):
+    """Describe an AutoFree.py run in one folder."""
+    return {
+        "name": folder.name,
+        "args": ["python", "AutoFree.py"],
+        "cwd": str(folder),
+        "stdout": str(folder / f"{structure_name(folder)}.out"),
+    }
+
+def autofree_outcome(folder, result):
+    """Check a finished AutoFree.py run."""
+    output_file = folder / f"{structure_name(folder)}.out"
+    log = [f"Running AutoFree.py in: {folder.name}", f"Output saved to: {output_file}"]
+    result["failure"] = classify_failure(result, output_file, check_complete=True)
+    if result["failure"] == "incomplete-output":
+        log.append(f"Warning: {output_file} has no vibrational energy lines")
+    log.extend(job_log(folder, "autofree", result))
+    return folder.name, failure_status(result["failure"]), "\n".join(log)
+
+def autofree_folder(folder):
+    """Run AutoFree.py in one folder."""
+    return run_folder_step(folder, "autofree")
+
+FOLDER_STEPS = {
+    "neighcrys": (neighcrys_command, neighcrys_outcome),
+    "autold": (autold_command, autold_outcome),
+    "autofree": (autofree_command, autofree_outcome),
+}
+
+def run_folder_step(folder, step):
+    """Run the external tool of a folder step and check its output.
+
+    Retryable failures are tried again after a growing delay, and a step
+    that still fails puts its structure in quarantine.
+    """
+    message = check_inputs(folder, step)
+    if message:
+        return folder.name, "skipped", message
+    command, outcome = FOLDER_STEPS[step]
+    logs = []
+    attempt = 0
+    while True:
+        attempt += 1
+        if WARM_SCRIPTS and step in SCRIPT_STEPS:
+            result = run_script_job(command(folder), JOB_TIMEOUT)
+        elif DAEMON_SOCKET:
+            result = run_on_daemon_sync(command(folder), DAEMON_SOCKET, JOB_TIMEOUT)
+        else:
+            result = run_job_sync(command(folder), JOB_TIMEOUT)
+        name, status, log = outcome(folder, result)
+        logs.append(log)
+        if not should_retry(result, attempt):
+            break
+        delay, message = retry_message(result, attempt)
+        logs.append(message)
+        time.sleep(delay)
+    if status != "completed":
+        logs.append(quarantine(folder, step, result, attempt))
+    return name, status, "\n".join(logs)
+
 def run_autofree_in_folders(root_dir):
     """Run AutoFree.py in each folder."""
-    for folder in Path(root_dir).iterdir():
-        if folder.is_dir():
-            autofree_script = folder / "AutoFree.py"
-            if autofree_script.exists():
-                output_file = folder / f"{folder.name}.out"
-                print(f"Running AutoFree.py in: {folder.name}")
-                try:
-                    with open(output_file, "w") as outfile:
-                        subprocess.run(
-                            ["python", str(autofree_script)],
-                            stdout=outfile,
-                            stderr=subprocess.PIPE,
-                            text=True,
-                            cwd=folder
-                        )
-                    print(f"Output saved to: {output_file}")
-                except Exception as e:
-                    print(f"Error running AutoFree.py in {folder.name}: {e}")
+    skipped = skipped_structures(root_dir)
+    folders = [folder for folder in Path(root_dir).iterdir()
+               if folder.is_dir() and next_step(folder, skipped) == "autofree"]
+    folders = in_energy_order(folders, root_dir)
+    record_stage(root_dir, "autofree", run_stage("AutoFree", autofree_folder, folders))
+    print("AutoFree.py execution completed")
+
+class PipelineRun:
+    """Job slots, step counts and worker pools shared by every job of one run."""
+
+    def __init__(self, workers, warm_scripts=False):
+        self.workers = workers
+        self.slots = PrioritySlots(workers)
+        # Dispatch priority of each structure folder, see structure_priorities
+        self.priority = {}
+        # Pre-filter skip list of each structure folder root, see skipped_in
+        self.skipped = {}
+        # Scratch directories staged ahead of the job slots, so the next
+        # dmacrys inputs are copied while the current jobs still run
+        self.prefetch = asyncio.Semaphore(2 * workers)
+        # One core set per job slot, handed to each job while it holds the slot
+        self.cpu_pool = core_sets(workers, NUMA_NODE) if PIN_CPUS else None
+        self.memory = MemoryGate(MEMORY_FRACTION) if MEMORY_FRACTION else None
+        # Peak RSS per (structure, step) and per cell atom per step, from logs and finished jobs
+        self.peak_rss = {}
+        self.kb_per_atom = {}
+        self.history_roots = set()
+        self.counts = defaultdict(lambda: {"completed": 0, "skipped": 0, "failed": 0, "timeout": 0})
+        # dmacrys cache keys being computed, so identical jobs wait for the first one
+        self.cache_waits = {}
+        self.cache_hits = 0
+        self.saved_cpu = 0.0
+        # Total run time of finished dmacrys jobs per structure, to spot stragglers by
+        self.run_times = defaultdict(list)
+        self.run_time_folders = set()
+        self.speculated = 0
+        self.speculation_wins = 0
+        self.script_pool = None
+        if warm_scripts:
+            self.script_pool = ProcessPoolExecutor(max_workers=workers, initializer=preload_imports)
+
+    def skipped_in(self, folder):
+        """The structures the pre-filter skipped in the root of folder, read once per root."""
+        root = Path(folder).parent
+        if root not in self.skipped:
+            self.skipped[root] = skipped_structures(root)
+        return self.skipped[root]
+
+    def priority_of(self, folder):
+        return self.priority.get(Path(folder), (float("inf"),))
+
+    def slot(self, folder):
+        """A job slot for a job of folder, handed out in structure priority order."""
+        return self.slots.at(self.priority_of(folder))
+
+    async def run_tool(self, job, folder, step):
+        """Run an external tool for folder in one of the run's job slots, on the job daemon with DAEMON_SOCKET.
+
+        Memory is admitted before the job takes its slot, so no slot is held
+        by a job waiting for memory. A job handed to the
+        daemon holds its slot while it queues and runs there, so the slots
+        only cap how many jobs this run has submitted at once; the daemon
+        starts them when the node has room, in structure priority order
+        among this run's jobs.
+        """
+        async with memory_admission(folder, step, self):
+            async with self.slot(folder):
+                if DAEMON_SOCKET is None:
+                    return await run_job(job, None, JOB_TIMEOUT, self.cpu_pool)
+                return await run_on_daemon(job, DAEMON_SOCKET, JOB_TIMEOUT, self.priority_of(folder))
+
+    def close(self):
+        if self.script_pool:
+            self.script_pool.shutdown()
+
+async def run_structure(folder, run):
+    """Take one structure through its remaining steps, one after another."""
+    skipped = run.skipped_in(folder)
+    step = next_step(folder, skipped)
+    if step is None:
+        if is_quarantined(folder):
+            state = "quarantined"
+        elif is_skipped(folder, skipped):
+            state = "outside the energy pre-filter"
+        else:
+            state = "already complete"
+        print(f"Skipping {folder.name}: {state}")
+        return
+    while step is not None:
+        if step == "spli":
+            remove_spli_lines(folder / f"{structure_name(folder)}.res.dmain")
+            status = "completed"
+        elif step == "dmacrys":
+            dmain_files = sorted(path for path in folder.glob("*.dmain") if is_dmain_pending(path))
+            statuses = await asyncio.gather(*(run_dmacrys_job(dmain_file, run)
+                                              for dmain_file in dmain_files))
+            status = "completed"
+            for job_status in statuses:
+                if job_status != "completed":
+                    status = job_status
+        else:
+            message = check_inputs(folder, step)
+            if message:
+                print(message)
+                status = "skipped"
             else:
-                print(f"Skipping {folder.name}: AutoFree.py not found")
+                status = await run_folder_job(folder, step, run)
+            run.counts[step][status] += 1
+
+        if status != "completed":
+            print(f"Stopping {folder.name}: {step} {status}")
+            return
+        mark_step_done(folder, step)
+        step = next_step(folder, skipped)
+
+async def run_attempts(folder, step, attempt_once):
+    """Run a job until it succeeds, its failure is not worth retrying, or attempts run out.
+
+    attempt_once is a coroutine function returning the job result and its
+    checked outcome. Each attempt is reported as it ends, the delay between
+    attempts is spent without holding a job slot, and a job that still
+    fails puts its structure in quarantine.
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        result, outcome = await attempt_once()
+        _, status, _ = report_result(outcome)
+        if not should_retry(result, attempt):
+            break
+        delay, message = retry_message(result, attempt)
+        print(message)
+        await asyncio.sleep(delay)
+    if status != "completed":
+        print(quarantine(folder, step, result, attempt))
+    return status
+
+async def run_folder_job(folder, step, run):
+    """Run the external tool of a folder step, retrying it as needed."""
+    command, outcome = FOLDER_STEPS[step]
+
+    async def attempt_once():
+        if run.script_pool and step in SCRIPT_STEPS:
+            async with memory_admission(folder, step, run):
+                async with run.slot(folder):
+                    result = await asyncio.get_running_loop().run_in_executor(
+                        run.script_pool, run_script_job, command(folder), JOB_TIMEOUT)
         else:
-            print(f"Skipping {folder.name}: Not a directory")
-    print("AutoFree.py execution completed")
+            result = await run.run_tool(command(folder), folder, step)
+        learn_peak(folder, step, result, run)
+        return result, outcome(folder, result)
+
+    return await run_attempts(folder, step, attempt_once)
+
+async def run_dmacrys_job(dmain_file, run):
+    """Run one displaced-supercell dmacrys job, retrying it as needed.
+
+    With SCRATCH_DIR set, the inputs are staged into node-local scratch
+    before a job slot is taken, and everything dmacrys writes is copied back.
+    With DMACRYS_CACHE set, a job whose inputs match an earlier run gets
+    that run's .dmaout instead, and identical jobs of the same run wait
+    for the first of them rather than computing it twice.
+    """
+    if DMACRYS_CACHE is None:
+        key = None
+    else:
+        key = await asyncio.get_running_loop().run_in_executor(None, cache_key, dmain_file)
+        while key in run.cache_waits:
+            await run.cache_waits[key].wait()
+        if use_cached_dmaout(dmain_file, key, run):
+            return "completed"
+        run.cache_waits[key] = asyncio.Event()
+    try:
+        status = await run_attempts(dmain_file.parent, "dmacrys",
+                                    lambda: run_dmacrys_once(dmain_file, run, key))
+    finally:
+        if key is not None:
+            run.cache_waits.pop(key).set()
+    run.counts["dmacrys"][status] += 1
+    return status
+
+def use_cached_dmaout(dmain_file, key, run):
+    """Give a .dmain file the cached .dmaout of identical inputs, if there is one."""
+    cached = cached_output(DMACRYS_CACHE, key)
+    if cached is None:
+        return False
+    output_file = dmain_file.with_suffix(".dmaout")
+    materialize_output(cached, output_file)
+    saved = cached_cpu_seconds(DMACRYS_CACHE, key)
+    run.cache_hits += 1
+    run.saved_cpu += saved
+    append_csv_row(dmain_file.parent.parent / CACHE_LOG,
+                   ["structure", "job", "key", "saved_cpu_s", "hit at"],
+                   [structure_name(dmain_file.parent), dmain_file.name, key, f"{saved:.3f}",
+                    time.strftime("%Y-%m-%d %H:%M:%S")])
+    print(f"Reused cached dmacrys output for {dmain_file}, saving {saved:.1f} CPU s")
+    return True
+
+def report_cache(run):
+    if DMACRYS_CACHE is not None:
+        print(f"dmacrys cache: {run.cache_hits} jobs reused, "
+              f"{run.saved_cpu / 3600:.2f} CPU-hours saved")
+
+async def run_dmacrys_once(dmain_file, run, key=None):
+    """Run one attempt of a dmacrys job and check its output, caching it under key if it finished."""
+    if SPECULATE:
+        result = await run_dmacrys_speculatively(dmain_file, run)
+    elif SCRATCH_DIR is None:
+        result = await run.run_tool(dmacrys_command(dmain_file), dmain_file.parent, "dmacrys")
+    else:
+        loop = asyncio.get_running_loop()
+        async with run.prefetch:
+            try:
+                scratch = await loop.run_in_executor(None, stage_in, dmain_file)
+            except OSError as e:
+                result = {"name": dmain_file.name, "status": "failed", "returncode": None,
+                          "stderr": f"Could not stage into {SCRATCH_DIR}: {e}", "wall": 0.0}
+            else:
+                try:
+                    result = await run.run_tool(dmacrys_command(dmain_file, scratch), dmain_file.parent, "dmacrys")
+                finally:
+                    await loop.run_in_executor(None, stage_out, dmain_file, scratch)
+    learn_peak(dmain_file.parent, "dmacrys", result, run)
+    outcome = dmacrys_outcome(dmain_file, result)
+    if SPECULATE and result["failure"] is None:
+        seconds = dmacrys_run_time(dmain_file.with_suffix(".dmaout"))
+        if seconds is not None:
+            run.run_times[structure_name(dmain_file.parent)].append(seconds)
+    if key is not None and result["failure"] is None:
+        cpu_seconds = (result.get("user") or 0.0) + (result.get("sys") or 0.0)
+        store_output(DMACRYS_CACHE, key, dmain_file.with_suffix(".dmaout"), cpu_seconds)
+    return result, outcome
+
+def dmacrys_run_time(dmaout_file):
+    """Return the Total run time in the footer of a finished .dmaout, or None."""
+    try:
+        with open_output(dmaout_file) as f:
+            for line in f:
+                if "Total run time" in line:
+                    return float(line.split()[-1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+def learn_run_times(folder, run):
+    """Read the Total run time of the dmacrys jobs a folder finished before this run, once per folder."""
+    if folder in run.run_time_folders:
+        return
+    run.run_time_folders.add(folder)
+    for dmaout_file in folder.glob("*.dmaout*"):
+        seconds = dmacrys_run_time(dmaout_file)
+        if seconds is not None:
+            run.run_times[structure_name(folder)].append(seconds)
+
+def predicted_run_time(dmain_file, run):
+    """Predict the run time of a dmacrys job as the median of its structure's finished jobs.
+
+    The displacements of one structure cost about the same. A structure
+    with none finished yet is predicted from every finished job, once
+    there are a few.
+    """
+    samples = run.run_times.get(structure_name(dmain_file.parent))
+    if not samples:
+        samples = [seconds for times in run.run_times.values() for seconds in times]
+        if len(samples) < 3:
+            return None
+    return statistics.median(samples)
+
+def is_straggler(dmain_file, elapsed, run):
+    predicted = predicted_run_time(dmain_file, run)
+    return predicted is not None and elapsed > max(SPECULATE_FACTOR * predicted, SPECULATE_MIN_SECONDS)
+
+async def run_speculative_copy(dmain_file, run):
+    """Run a duplicate of a dmacrys job in a scratch directory of its own and return its result and directory."""
+    loop = asyncio.get_running_loop()
+    scratch = await loop.run_in_executor(None, stage_in, dmain_file, SCRATCH_DIR or tempfile.gettempdir())
+    try:
+        async with memory_admission(dmain_file.parent, "dmacrys", run, (float("inf"),)):
+            async with run.slots.at((float("inf"),)):
+                result = await run_job(dmacrys_command(dmain_file, scratch), None, JOB_TIMEOUT, run.cpu_pool)
+    except BaseException:
+        shutil.rmtree(scratch, ignore_errors=True)
+        raise
+    return result, scratch
+
+def run_succeeded(result, output_file):
+    return result["status"] == "completed" and is_complete(output_file)
+
+async def run_dmacrys_speculatively(dmain_file, run):
+    """Run a dmacrys job, racing a duplicate against it if it straggles while slots sit idle.
+
+    The job writes its .dmaout in place as usual, while the duplicate runs
+    in a scratch directory of its own, so the two never write the same
+    file. Whichever first finishes with a complete output wins and the
+    other is killed; a winning duplicate's .dmaout is moved into place
+    atomically.
+    """
+    folder = dmain_file.parent
+    output_file = dmain_file.with_suffix(".dmaout")
+    learn_run_times(folder, run)
+    async with memory_admission(folder, "dmacrys", run):
+        async with run.slot(folder):
+            start = time.monotonic()
+            original = asyncio.ensure_future(run_job(dmacrys_command(dmain_file), None, JOB_TIMEOUT, run.cpu_pool))
+            copy = None
+            try:
+                while not original.done():
+                    await asyncio.wait({original}, timeout=SPECULATE_POLL)
+                    if (not original.done() and run.slots.idle()
+                            and is_straggler(dmain_file, time.monotonic() - start, run)):
+                        print(f"{dmain_file} has run {time.monotonic() - start:.0f} s against a predicted "
+                              f"{predicted_run_time(dmain_file, run):.1f} s, starting a speculative copy")
+                        run.speculated += 1
+                        copy = asyncio.ensure_future(run_speculative_copy(dmain_file, run))
+                        break
+                if copy is None:
+                    return original.result()
+                pending = {original, copy}
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    if original in done and run_succeeded(original.result(), output_file):
+                        print(f"{dmain_file.name} finished before its speculative copy, killing the copy")
+                        break
+                    if (copy in done and copy.exception() is None
+                            and run_succeeded(copy.result()[0], copy.result()[1] / output_file.name)):
+                        print(f"Speculative copy of {dmain_file.name} finished first, killing the original")
+                        original.cancel()
+                        await asyncio.gather(original, return_exceptions=True)
+                        await asyncio.get_running_loop().run_in_executor(None, stage_out, dmain_file,
+                                                                         copy.result()[1])
+                        run.speculation_wins += 1
+                        return copy.result()[0]
+                return original.result()
+            finally:
+                for task in (original, copy):
+                    if task is not None and not task.done():
+                        task.cancel()
+                await asyncio.gather(*(task for task in (original, copy) if task is not None),
+                                     return_exceptions=True)
+                if copy is not None and copy.done() and not copy.cancelled() and copy.exception() is None:
+                    shutil.rmtree(copy.result()[1], ignore_errors=True)
+
+def report_speculation(run):
+    if SPECULATE:
+        print(f"Speculative execution: {run.speculated} straggling dmacrys jobs duplicated, "
+              f"{run.speculation_wins} won by the duplicate")
+
+async def run_pipeline_async(root_dirs, workers):
+    """Run every structure below the root_dirs concurrently, sharing workers job slots."""
+    priorities = structure_priorities(root_dirs, INTERLEAVE_MOLECULES)
+    return await run_folders_async(sorted(priorities, key=priorities.get), workers, priorities)
+
+async def run_folders_async(folders, workers, priorities=None):
+    """Run the given structure folders concurrently, by default in the order given."""
+    run = PipelineRun(workers, WARM_SCRIPTS)
+    run.priority = priorities or {folder: (rank,) for rank, folder in enumerate(folders)}
+    try:
+        await asyncio.gather(*(run_structure(folder, run) for folder in folders))
+    finally:
+        run.close()
+    report_cache(run)
+    report_speculation(run)
+    return run.counts
+
+def run_pipeline_dag(root_dirs, workers=None):
+    """Run neighcrys, SPLI removal, AutoLD, dmacrys and AutoFree as a per-structure task graph.
+
+    Each structure moves on to its next step as soon as its own previous step
+    finishes, instead of waiting for every other structure. The displaced
+    .dmain files written by AutoLD are only known once it has run, so their
+    dmacrys jobs join the graph at that point and AutoFree follows the last
+    of them. A failed step stops the remaining steps for that structure.
+    Structures resume from the first step their manifest does not show as
+    done. At most workers external tools run at any one time. With
+    WARM_SCRIPTS, AutoLD and AutoFree run inside a pool of warm workers
+    instead of a new interpreter each, and with SCRATCH_DIR, dmacrys runs
+    in node-local scratch. root_dirs may be one structure folder root or a
+    list of them, e.g. one per molecule, which then share the same pool.
+    """
+    if isinstance(root_dirs, (str, Path)):
+        root_dirs = [root_dirs]
+    counts = asyncio.run(run_pipeline_async(root_dirs, workers or WORKERS))
+    report_counts(counts)
+    print("Task graph completed")
+
+def report_counts(counts):
+    """Print how the jobs of each step of a run ended."""
+    for step in ["neighcrys", "autold", "dmacrys", "autofree"]:
+        print(f"{step} summary: {counts[step]['completed']} completed, "
+              f"{counts[step]['skipped']} skipped, {counts[step]['failed']} failed, "
+              f"{counts[step]['timeout']} timed out")
+
+def copy_atomically(source, destination):
+    tmp_path = destination.with_name(f".{destination.name}.tmp")
+    shutil.copy2(source, tmp_path)
+    os.replace(tmp_path, destination)
+
+def make_k_folder(source, k_value, parent=None):
+    """Set up a k_value_X folder from a folder whose neighcrys and SPLI steps are done.
+
+    Inputs shared through the input store are linked, the files neighcrys
+    and dmacrys wrote are copied so AutoLD can work on them in place, and
+    the displaced files and outputs of an earlier k are left out. Outputs
+    compressed since are copied back out plain. The new folder goes into
+    parent, by default next to source.
+    """
+    k_dir = Path(parent or source.parent) / f"{K_FOLDER_PREFIX}{k_value}"
+    if "spli" in load_manifest(k_dir):
+        return k_dir
+    if is_pruned(source):
+        raise FileNotFoundError(f"{source} has been pruned, restore it with retention.py before "
+                                f"running it at k = {k_value}")
+    k_dir.mkdir(exist_ok=True)
+    for path in source.iterdir():
+        if (not path.is_file() or path.name.startswith(".")
+                or any(fnmatch(plain_name(path.name), pattern) for pattern in K_FOLDER_SKIP)):
+            continue
+        if compressed_format(path):
+            decompress_file(path, k_dir / plain_name(path.name))
+        elif path.stat().st_nlink > 1:
+            link_input(store_input(path), k_dir / path.name)
+        else:
+            copy_atomically(path, k_dir / path.name)
+    mark_step_done(k_dir, "neighcrys")
+    mark_step_done(k_dir, "spli")
+    return k_dir
+
+def read_free_energy(out_file):
+    """Return the Epanechnikov KDE vibrational energy of an AutoFree .out file, or None."""
+    if not is_complete(out_file):
+        return None
+    with open_output(out_file) as f:
+        for line in f:
+            if "Epanechnikov KDE vibrational energy:" in line:
+                return float(line.split()[-2])
+    return None
+
+def corrected_energies(root_dir, refine_k=None):
+    """Add the free energy of every finished structure of a root to its static energy.
+
+    The free energy comes from the structure's k_value_<refine_k> folder
+    where that has finished, otherwise from the structure folder itself.
+    Returns {structure: (static energy, free energy, k spacing)}.
+    """
+    static = load_static_energies(root_dir)
+    energies = {}
+    for folder in sorted(Path(root_dir).iterdir()):
+        name = structure_name(folder) if folder.is_dir() else None
+        if name not in static:
+            continue
+        candidates = [(folder / f"{K_FOLDER_PREFIX}{refine_k}", refine_k)] if refine_k else []
+        for k_dir, k_value in candidates + [(folder, K_SPACING)]:
+            free_energy = read_free_energy(k_dir / f"{name}.out")
+            if free_energy is not None:
+                energies[name] = (static[name], free_energy, k_value)
+                break
+    return energies
+
+def near_rank_boundaries(corrected, top_n=None, observed=(), margin=REFINE_MARGIN):
+    """Pick the structures whose corrected energy is within margin of a rank boundary that matters.
+
+    One boundary lies halfway between the top_n-th and the next corrected
+    energy, and every observed structure is one as well, so these are the
+    structures that a change of margin kJ/mol could move across the top-N
+    cut or past an observed structure.
+    """
+    ranked = sorted(corrected, key=corrected.get)
+    boundaries = []
+    if top_n and len(ranked) > top_n:
+        boundaries.append((corrected[ranked[top_n - 1]] + corrected[ranked[top_n]]) / 2)
+    boundaries.extend(corrected[name] for name in observed if name in corrected)
+    return {name for name in ranked if any(abs(corrected[name] - boundary) <= margin for boundary in boundaries)}
+
+def write_refined_ranking(root_dir, refine_k):
+    """Rank the structures of a root by corrected energy, fine k values used where there are any."""
+    energies = corrected_energies(root_dir, refine_k)
+    original = sorted(energies, key=lambda name: energies[name][0])
+    ranked = sorted(energies, key=lambda name: energies[name][0] + energies[name][1])
+    csv_path = Path(root_dir).parent / REFINED_RANKING
+    tmp_path = csv_path.with_suffix(".tmp")
+    with open(tmp_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "energy", "free energy", "k_spacing", "new energy", "original rank", "new rank"])
+        for rank, name in enumerate(ranked, start=1):
+            static, free_energy, k_value = energies[name]
+            writer.writerow([name, static, free_energy, k_value, static + free_energy,
+                             original.index(name) + 1, rank])
+    os.replace(tmp_path, csv_path)
+    print(f"Ranking of {len(ranked)} structures written to {csv_path}")
+
+def refine_near_boundaries(root_dirs, refine_k, top_n=None, observed=(), margin=REFINE_MARGIN, workers=None):
+    """Rerun at refine_k the structures whose rank a finer k-point spacing could change.
+
+    This is the second pass after the whole task graph has run at
+    K_SPACING: each structure near a rank boundary gets a k_value_X folder
+    of its own, seeded from its finished neighcrys and undisplaced dmacrys
+    outputs, and the ranking is then written with the fine values where
+    they exist.
+    """
+    folders = []
+    for root_dir in root_dirs:
+        energies = corrected_energies(root_dir)
+        corrected = {name: static + free_energy for name, (static, free_energy, _) in energies.items()}
+        selected = near_rank_boundaries(corrected, top_n, observed, margin)
+        print(f"Refining {len(selected)} of {len(corrected)} structures in {root_dir} at k = {refine_k}")
+        for name in sorted(selected, key=corrected.get):
+            folder = Path(root_dir) / name
+            if is_pruned(folder) and "spli" not in load_manifest(folder / f"{K_FOLDER_PREFIX}{refine_k}"):
+                print(f"Skipping {name}: pruned, restore it with retention.py to refine it")
+                continue
+            folders.append(make_k_folder(folder, refine_k, folder))
+    if folders:
+        report_counts(asyncio.run(run_folders_async(folders, workers or WORKERS)))
+    for root_dir in root_dirs:
+        write_refined_ranking(root_dir, refine_k)
+
+def check_daemon(parser, args):
+    """Refuse options the job daemon takes over, and make sure it is listening."""
+    for option, value in [("--warm", args.warm), ("--pin", args.pin), ("--speculate", args.speculate)]:
+        if value:
+            parser.error(f"{option} cannot be combined with --daemon, the daemon decides where and "
+                         "when jobs run")
+    try:
+        status = daemon_status(args.daemon)
+    except (OSError, RuntimeError) as e:
+        parser.error(f"No job daemon answering on {args.daemon}: {e}")
+    print(f"Handing jobs to the job daemon on {args.daemon}: {status['workers'] - status['free']} "
+          f"of {status['workers']} slots busy")
+
+def find_molecules(names=None, molecules_dir=None):
+    """Resolve the molecules of a run to (crystal name, structure folder root) pairs.
+
+    Named molecules are looked up as <molecules_dir>/<name>/structure-files,
+    as in running-auto-free-final.py. Without names, every subdirectory of
+    molecules_dir that has a structure-files folder is a molecule, and
+    without either the run covers CRYSTAL_NAME in ROOT_DIR.
+    """
+    base = Path(molecules_dir or ".")
+    if names:
+        molecules = [(name, base / name / "structure-files") for name in names]
+    elif molecules_dir:
+        molecules = [(path.name, path / "structure-files") for path in sorted(base.iterdir())
+                     if (path / "structure-files").is_dir()]
+    else:
+        molecules = [(CRYSTAL_NAME, Path(ROOT_DIR))]
+    for name, root_dir in molecules:
+        if not root_dir.is_dir():
+            raise FileNotFoundError(f"Missing structure folder for {name}: {root_dir}")
+    return molecules
 
 if __name__ == "__main__":
-    # Step 1: Organize .res files into folders
-    print("Organising .res files.")
-    organize_res_files(ROOT_DIR)
-    print("Completed Task.")
-
-    # Step 2: Copy required files into each folder
-    print("Fetching required files.")
-    organize_crystal_files(ROOT_DIR)
-    print("Completed Task.")
-
-    # Step 3: Create fort.22 files in each folder
-    print("Creating fort.22 files.")
-    create_fort22_files(ROOT_DIR)
-    print("Completed Task.")
-
-    # Step 4: Run neighcrys on each fort.22 file
-    print("Starting NEIGHCRYS calculations.")
-    process_folders(ROOT_DIR)
-    print("Completed Task.")
-
-    # Step 5: Remove 'SPLI' lines from .res.dmain files
-    print("Removing SPLI line from all .dmain files.")
-    process_dmain_files(ROOT_DIR)
-    print("Completed Task.")
-
-    # Step 6: Copy AutoFree.py and AutoLD.py into each folder
-    print("Fetching required files.")
-    copy_scripts_to_folders(ROOT_DIR, SCRIPTS_TO_COPY)
-    print("Completed Task.")
-
-    # Step 7: Run AutoLD.py in each folder
-    print("Running AutoLD.")
-    run_autold_in_folders(ROOT_DIR)
-    print("Completed Task.")
-
-    # Step 8: Run dmacrys2.2.1 on each .dmain file
-    # print("Starting DMACRYS calculations.")
-    # run_dmacrys_on_dmain(ROOT_DIR)
-    # print("Completed Task.")
-
-    # Step 9: Run AutoFree.py in each folder
-    # print("Running AutoFree.")
-    # run_autofree_in_folders(ROOT_DIR)
-    # print("Completed Task.")
-
-    # print("All tasks completed!")
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Run the phonon pipeline over ROOT_DIR or a batch of molecules.",
+                                     fromfile_prefix_chars="@")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="number of worker processes per stage (default: 1, serial)")
+    parser.add_argument("--barriers", action="store_true",
+                        help="finish each step for all structures before starting the next")
+    parser.add_argument("--timeout", type=float, default=JOB_TIMEOUT,
+                        help="seconds before a neighcrys, AutoLD, dmacrys or AutoFree job is killed")
+    parser.add_argument("--warm", action="store_true",
+                        help="run AutoLD.py and AutoFree.py inside warm worker processes")
+    parser.add_argument("--retries", type=int, default=MAX_ATTEMPTS - 1,
+                        help="retries of a job after a launch error, non-zero exit or empty output")
+    parser.add_argument("--retry-quarantined", action="store_true",
+                        help="release quarantined structures and try them again")
+    parser.add_argument("--scratch", nargs="?", const=os.environ.get("TMPDIR", "/dev/shm"),
+                        default=SCRATCH_DIR,
+                        help="run dmacrys in node-local scratch (default: $TMPDIR or /dev/shm)")
+    parser.add_argument("--dmacrys-cache", nargs="?", const="dmacrys-cache", default=None,
+                        metavar="DIR",
+                        help="reuse the .dmaout of dmacrys inputs identical to an earlier run, "
+                             "cached in DIR (default dmacrys-cache)")
+    parser.add_argument("--pin", action="store_true",
+                        help="pin each concurrent job to its own set of cores (task graph only)")
+    parser.add_argument("--numa-node", type=int, default=NUMA_NODE,
+                        help="with --pin, keep every job on the cores of this NUMA node")
+    parser.add_argument("--threads-per-job", type=int, default=THREADS_PER_JOB,
+                        help="OpenMP/BLAS threads per dmacrys job (default: its pinned cores, "
+                             "or the library default without --pin)")
+    parser.add_argument("--memory-fraction", type=float, default=MEMORY_FRACTION,
+                        help="only start dmacrys/AutoFree jobs while their projected peak memory "
+                             "fits in this fraction of MemAvailable (e.g. 0.8)")
+    parser.add_argument("--interleave", action="store_true",
+                        help="alternate between molecules by static energy rank instead of "
+                             "finishing one molecule before the next")
+    parser.add_argument("--energy-window", type=float, default=ENERGY_WINDOW,
+                        help="only run structures within this many kJ/mol of the lowest static energy")
+    parser.add_argument("--window-from-rankings", nargs="?", const=RANKINGS_DIR, default=None,
+                        metavar="DIR",
+                        help="set the energy window from the free energy spread in DIR/*.csv "
+                             f"(default {RANKINGS_DIR}) times {WINDOW_MARGIN}")
+    parser.add_argument("--top-n", type=int, default=TOP_N,
+                        help="only run this many structures of lowest static energy")
+    parser.add_argument("--k-spacing", default=K_SPACING,
+                        help=f"k-point spacing passed to AutoLD.py -k (default {K_SPACING})")
+    parser.add_argument("--refine-k", default=REFINE_K_SPACING, metavar="SPACING",
+                        help="after the run, rerun the structures near a rank boundary at this finer "
+                             "spacing, e.g. --k-spacing 0.30 --refine-k 0.12")
+    parser.add_argument("--refine-margin", type=float, default=REFINE_MARGIN,
+                        help=f"kJ/mol either side of a rank boundary to refine (default {REFINE_MARGIN})")
+    parser.add_argument("--refine-top-n", type=int, default=REFINE_TOP_N,
+                        help="refine the structures near the cut between the top N and the rest")
+    parser.add_argument("--observed", nargs="+", default=OBSERVED_STRUCTURES, metavar="ID",
+                        help="refine the structures near these observed structure ids")
+    parser.add_argument("--speculate", nargs="?", type=float, const=SPECULATE_FACTOR, default=None,
+                        metavar="FACTOR",
+                        help="once slots sit idle, race a duplicate against any dmacrys job running "
+                             f"FACTOR (default {SPECULATE_FACTOR}) times longer than its structure's "
+                             "finished jobs took")
+    parser.add_argument("--daemon", nargs="?", const=DEFAULT_DAEMON_SOCKET, default=DAEMON_SOCKET,
+                        metavar="SOCKET",
+                        help="hand every job to the job daemon on SOCKET (default "
+                             f"{DEFAULT_DAEMON_SOCKET}), sharing the node with other runs; --workers "
+                             "then caps the jobs this run has submitted at once")
+    parser.add_argument("--compress", nargs="?", const="", default=None, metavar="FORMAT",
+                        help="compress the .dmaout and .out files of finished structures after the run, "
+                             "with zstd, gzip or xz (default: the first available)")
+    parser.add_argument("--molecules", nargs="+", metavar="NAME",
+                        help="molecules to run together, each from <name>/structure-files "
+                             "(use @file to read the names from a file)")
+    parser.add_argument("--molecules-dir",
+                        help="directory holding one <name>/structure-files per molecule; "
+                             "without --molecules every such molecule is run")
+    args = parser.parse_args()
+    WORKERS = args.workers
+    JOB_TIMEOUT = args.timeout
+    WARM_SCRIPTS = args.warm
+    SCRATCH_DIR = args.scratch
+    DMACRYS_CACHE = args.dmacrys_cache
+    PIN_CPUS = args.pin
+    NUMA_NODE = args.numa_node
+    THREADS_PER_JOB = args.threads_per_job
+    MEMORY_FRACTION = args.memory_fraction
+    SPECULATE = args.speculate is not None
+    SPECULATE_FACTOR = args.speculate or SPECULATE_FACTOR
+    DAEMON_SOCKET = args.daemon
+    if DAEMON_SOCKET:
+        check_daemon(parser, args)
+    INTERLEAVE_MOLECULES = args.interleave
+    ENERGY_WINDOW = args.energy_window
+    if args.window_from_rankings:
+        ENERGY_WINDOW = free_energy_window(args.window_from_rankings)
+    TOP_N = args.top_n
+    K_SPACING = args.k_spacing
+    REFINE_K_SPACING = args.refine_k
+    REFINE_MARGIN = args.refine_margin
+    REFINE_TOP_N = args.refine_top_n
+    OBSERVED_STRUCTURES = args.observed
+    if SPECULATE and SCRATCH_DIR:
+        parser.error("--speculate runs dmacrys in place and cannot be combined with --scratch")
+    if PIN_CPUS and args.barriers:
+        parser.error("--pin only applies to the task graph and cannot be combined with --barriers")
+    if REFINE_K_SPACING and args.barriers:
+        parser.error("--refine-k runs on the task graph and cannot be combined with --barriers")
+    MAX_ATTEMPTS = args.retries + 1
+    molecules = find_molecules(args.molecules, args.molecules_dir)
+    if args.retry_quarantined:
+        for _, root_dir in molecules:
+            release_quarantine(root_dir)
+
+    for crystal_name, root_dir in molecules:
+        # Step 0: Skip structures too high in static energy to reach the top ranks
+        skipped = prefilter_structures(root_dir, ENERGY_WINDOW, TOP_N)
+
+        # Step 1: Organize .res files into folders
+        print(f"Organising .res files for {crystal_name}.")
+        organize_res_files(root_dir, skipped)
+        print("Completed Task.")
+
+        # Step 2: Copy required files into each folder
+        print("Fetching required files.")
+        organize_crystal_files(root_dir, crystal_name)
+        print("Completed Task.")
+
+        # Step 3: Create fort.22 files in each folder
+        print("Creating fort.22 files.")
+        create_fort22_files(root_dir)
+        print("Completed Task.")
+
+        if not args.barriers:
+            # Step 4: Copy AutoFree.py and AutoLD.py into each folder
+            print("Fetching required files.")
+            copy_scripts_to_folders(root_dir, SCRIPTS_TO_COPY)
+            print("Completed Task.")
+
+    if args.barriers:
+        for crystal_name, root_dir in molecules:
+            print(f"Running the pipeline step by step for {crystal_name}.")
+
+            # Step 4: Run neighcrys on each fort.22 file
+            print("Starting NEIGHCRYS calculations.")
+            process_folders(root_dir)
+            print("Completed Task.")
+
+            # Step 5: Remove 'SPLI' lines from .res.dmain files
+            print("Removing SPLI line from all .dmain files.")
+            process_dmain_files(root_dir)
+            print("Completed Task.")
+
+            # Step 6: Copy AutoFree.py and AutoLD.py into each folder
+            print("Fetching required files.")
+            copy_scripts_to_folders(root_dir, SCRIPTS_TO_COPY)
+            print("Completed Task.")
+
+            # Step 7: Run AutoLD.py in each folder
+            print("Running AutoLD.")
+            run_autold_in_folders(root_dir)
+            print("Completed Task.")
+
+            # Step 8: Run dmacrys2.2.1 on each .dmain file
+            print("Starting DMACRYS calculations.")
+            run_dmacrys_on_dmain(root_dir)
+            print("Completed Task.")
+
+            # Step 9: Run AutoFree.py in each folder
+            print("Running AutoFree.")
+            run_autofree_in_folders(root_dir)
+            print("Completed Task.")
+    else:
+        # Step 5: Run neighcrys, SPLI removal, AutoLD, dmacrys and AutoFree per structure,
+        # with the structures of every molecule sharing one pool
+        print("Starting task graph.")
+        run_pipeline_dag([root_dir for _, root_dir in molecules])
+        print("Completed Task.")
+
+        if REFINE_K_SPACING:
+            # Step 6: Rerun the structures whose rank the finer spacing could change
+            print(f"Refining structures near a rank boundary at k = {REFINE_K_SPACING}.")
+            refine_near_boundaries([root_dir for _, root_dir in molecules], REFINE_K_SPACING,
+                                   REFINE_TOP_N, OBSERVED_STRUCTURES, REFINE_MARGIN)
+            print("Completed Task.")
+
+    if args.compress is not None:
+        print("Compressing finished outputs.")
+        compress_outputs([root_dir for _, root_dir in molecules], args.compress or None)
+        print("Completed Task.")
+
+    for _, root_dir in molecules:
+        report_quarantine(root_dir)
+    print("All tasks completed!")
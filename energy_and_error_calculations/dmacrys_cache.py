@@ -0,0 +1,111 @@
+'''
+A cache of finished dmacrys runs, keyed by the hash of a .dmain file together with the potential
+files dmacrys reads alongside it. Different k-spacings often give the same supercell and so
+byte-identical displaced .dmain files; with the cache only the first of them is computed and the
+others get a link to its .dmaout.
+
+Each entry is <key>.dmaout, stored read-only, and <key>.json with the CPU time of the run that
+produced it. calculations.py logs every hit to CACHE_LOG next to the structure folders.
+
+Usage:
+    python dmacrys_cache.py report structure-files/dmacrys-cache.csv [...]
+'''
+
+import os
+import csv
+import json
+import stat
+import time
+import shutil
+import hashlib
+import argparse
+from pathlib import Path
+
+CACHE_INPUTS = ["fit.pots", "*.dma", "*.mols"]  # Files besides the .dmain that decide the result
+CACHE_LOG = "dmacrys-cache.csv"  # Hits, written next to the structure folders
+
+# Hashes of potential files, keyed by path, size and mtime, as every structure shares them
+_input_hashes = {}
+
+def input_hash(path):
+    """Return the SHA-256 hex digest of an input file, hashing each version only once."""
+    info = os.stat(path)
+    cache_id = (os.path.realpath(path), info.st_size, info.st_mtime_ns)
+    if cache_id not in _input_hashes:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+        _input_hashes[cache_id] = sha.hexdigest()
+    return _input_hashes[cache_id]
+
+def cache_key(dmain_file, inputs=CACHE_INPUTS):
+    """Hash a .dmain file with the potential files next to it into a cache key."""
+    dmain_file = Path(dmain_file)
+    sha = hashlib.sha256()
+    with open(dmain_file, "rb") as f:
+        sha.update(hashlib.sha256(f.read()).digest())
+    for pattern in inputs:
+        for path in sorted(dmain_file.parent.glob(pattern)):
+            sha.update(f"{path.name}\0{input_hash(path)}\0".encode())
+    return sha.hexdigest()
+
+def cached_output(cache_dir, key):
+    """Return the cached .dmaout for a key, or None on a miss."""
+    cached = Path(cache_dir) / f"{key}.dmaout"
+    return cached if cached.exists() else None
+
+def cached_cpu_seconds(cache_dir, key):
+    """Return the CPU seconds the cached run took, or 0.0 if unknown."""
+    try:
+        with open(Path(cache_dir) / f"{key}.json", "r") as f:
+            return float(json.load(f).get("cpu seconds") or 0.0)
+    except (OSError, ValueError):
+        return 0.0
+
+def store_output(cache_dir, key, dmaout_file, cpu_seconds=None):
+    """Add a finished .dmaout to the cache under key, unless it is already there."""
+    cache_dir = Path(cache_dir)
+    if cached_output(cache_dir, key):
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    record_tmp = cache_dir / f".{key}.json.{os.getpid()}.tmp"
+    with open(record_tmp, "w") as f:
+        json.dump({"source": str(dmaout_file), "cpu seconds": cpu_seconds,
+                   "stored at": time.strftime("%Y-%m-%d %H:%M:%S")}, f, indent=2)
+    os.replace(record_tmp, cache_dir / f"{key}.json")
+    tmp_path = cache_dir / f".{key}.dmaout.{os.getpid()}.tmp"
+    shutil.copy2(dmaout_file, tmp_path)
+    os.chmod(tmp_path, stat.S_IMODE(os.stat(tmp_path).st_mode) & ~0o222)
+    os.replace(tmp_path, cache_dir / f"{key}.dmaout")
+
+def materialize_output(cached, destination):
+    """Place a cached .dmaout at destination as a hardlink, or a copy across filesystems."""
+    destination = Path(destination)
+    tmp_path = destination.with_name(f".{destination.name}.tmp")
+    if tmp_path.exists():
+        tmp_path.unlink()
+    try:
+        os.link(cached, tmp_path)
+    except OSError:
+        shutil.copy2(cached, tmp_path)
+    os.replace(tmp_path, destination)
+
+def report(log_files):
+    """Print the hits and CPU-hours saved recorded in cache logs."""
+    hits = 0
+    saved = 0.0
+    for log_file in log_files:
+        with open(log_file, "r", newline="") as f:
+            for row in csv.DictReader(f):
+                hits += 1
+                saved += float(row["saved_cpu_s"] or 0.0)
+    print(f"{hits} dmacrys runs served from the cache, {saved / 3600:.2f} CPU-hours saved")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report on the dmacrys job cache.")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    report_parser = subparsers.add_parser("report", help="sum the hits in cache logs")
+    report_parser.add_argument("log_files", nargs="+")
+    args = parser.parse_args()
+    report(args.log_files)
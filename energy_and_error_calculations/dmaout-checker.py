@@ -1,6 +1,8 @@
 import os
 from collections import defaultdict
 
+from output_compression import plain_name
+
 def check_dmain_dmaout_counts(root_dir):
     """
     Check if each subdirectory has the same number of dmain and dmaout files.
@@ -17,9 +19,10 @@ def check_dmain_dmaout_counts(root_dir):
         
         # Count dmain and dmaout files in the current directory
         for filename in filenames:
-            if filename == 'dmain':
+            filename = plain_name(filename)  # Compressed .dmaout files count as well
+            if filename.endswith('.dmain'):
                 dmain_count += 1
-            elif filename == 'dmaout':
+            elif filename.endswith('.dmaout'):
                 dmaout_count += 1
         
         # Only record directories that have at least one of these files
@@ -0,0 +1,416 @@
+'''
+A job daemon that owns the worker slots of one node, so every pipeline script started on it shares
+them instead of each starting its own subprocesses. Scripts talk to it over a Unix socket: they
+submit jobs and wait for their results, or poll for them later.
+
+Slots are shared fairly between the submitting processes: a free slot goes to the process with the
+fewest running jobs, and within one submission to its job with the lowest priority value. A batch
+started alongside another one therefore gets its share of the node as soon as jobs finish, instead
+of queueing behind the whole earlier batch.
+
+Jobs are run by job_runner.run_job, with the working directory and environment of the script that
+submitted them, and as the user running the daemon. Only that user may connect: the socket is
+private to them and connections from other users are refused, as whoever submits a job picks the
+command and environment it runs with. Each user who wants to share a node between their own runs
+starts their own daemon.
+
+A job submitted with "run" is killed if its submitter disconnects before it finishes, while one
+submitted with "submit" keeps running and its result is held until fetched with "wait" or "poll".
+
+Usage:
+    python job_daemon.py serve [--socket PATH] [--workers N] [--timeout SECONDS] [--pin [--numa-node N]]
+    python job_daemon.py submit commands_1.txt [commands_2.txt ...] [--socket PATH] [--wait]
+    python job_daemon.py wait <id> [<id> ...] [--socket PATH]
+    python job_daemon.py poll <id> [<id> ...] [--socket PATH]
+    python job_daemon.py cancel <id> [<id> ...] [--socket PATH]
+    python job_daemon.py status [--socket PATH]
+'''
+
+import os
+import sys
+import json
+import time
+import heapq
+import signal
+import socket
+import struct
+import asyncio
+import argparse
+import itertools
+from collections import defaultdict
+
+from job_runner import run_job, job_result, core_sets
+
+# Socket the daemon listens on and the scripts connect to, private to the user and named after the node
+DAEMON_SOCKET = os.path.join(os.environ.get("XDG_RUNTIME_DIR") or os.path.expanduser("~"),
+                             f".pipeline-jobs-{socket.gethostname()}.sock")
+PATH_KEYS = ["cwd", "stdin", "stdout"]  # Job paths made absolute before they reach the daemon
+LOWEST_PRIORITY = [float("inf")]  # Priority of jobs submitted without one
+LINE_LIMIT = 1 << 26  # Longest request or reply line, a batch of commands or a job's stderr tail
+
+def send(writer, message):
+    writer.write((json.dumps(message) + "\n").encode())
+
+def portable_job(job):
+    """Make the paths of a job absolute, so it runs the same from the daemon's working directory."""
+    job = dict(job)
+    for key in PATH_KEYS:
+        if job.get(key):
+            job[key] = os.path.abspath(job[key])
+    job.setdefault("cwd", os.getcwd())
+    return job
+
+def job_request(op, jobs, timeout=None, priority=None):
+    """Build a run or submit request, carrying this process's environment for the jobs."""
+    return {"op": op, "jobs": [portable_job(job) for job in jobs], "env": dict(os.environ),
+            "timeout": timeout, "priority": list(priority) if priority else None}
+
+def peer_process(writer):
+    """Return the process id and user id of the process on the other end of a connection."""
+    sock = writer.get_extra_info("socket")
+    pid, uid, _ = struct.unpack("3i", sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                                      struct.calcsize("3i")))
+    return pid, uid
+
+class JobDaemon:
+    """Queued and running jobs of the node, handed the worker slots in fair-share order."""
+
+    def __init__(self, workers, timeout=None, cpu_pool=None):
+        self.workers = workers
+        self.free = workers
+        self.timeout = timeout
+        self.cpu_pool = cpu_pool
+        self.jobs = {}
+        # Queued job ids per submitting process, as heaps of (priority, order, id)
+        self.queued = defaultdict(list)
+        # Running jobs and the order of the last slot handed out, per submitting process
+        self.running = defaultdict(int)
+        self.last_start = {}
+        self.order = itertools.count()
+        self.ids = itertools.count(1)
+        self.stopping = False
+
+    def submit(self, client, job, priority=None, timeout=None):
+        """Queue one job and return its id."""
+        job_id = next(self.ids)
+        record = {
+            "id": job_id,
+            "client": client,
+            "name": job.get("name", job["args"][0]),
+            "job": job,
+            "timeout": timeout if timeout is not None else self.timeout,
+            "state": "queued",
+            "submitted": time.monotonic(),
+            "result": None,
+            "done": asyncio.Event(),
+            "task": None,
+        }
+        self.jobs[job_id] = record
+        heapq.heappush(self.queued[client], (priority or LOWEST_PRIORITY, next(self.order), job_id))
+        return job_id
+
+    def next_job(self):
+        """Pop the queued job the next free slot belongs to, or return None."""
+        if not self.queued:
+            return None
+        client = min(self.queued, key=lambda client: (self.running[client], self.last_start.get(client, -1)))
+        _, _, job_id = heapq.heappop(self.queued[client])
+        if not self.queued[client]:
+            del self.queued[client]
+        return self.jobs[job_id]
+
+    def dispatch(self):
+        """Start queued jobs while slots are free."""
+        while self.free > 0 and not self.stopping:
+            record = self.next_job()
+            if record is None:
+                return
+            self.free -= 1
+            self.running[record["client"]] += 1
+            self.last_start[record["client"]] = next(self.order)
+            record["state"] = "running"
+            record["started"] = time.monotonic()
+            record["task"] = asyncio.ensure_future(self.run(record))
+
+    async def run(self, record):
+        """Run one job in its slot, and always free the slot and store a result afterwards."""
+        result = None
+        try:
+            result = await run_job(record["job"], None, record["timeout"], self.cpu_pool)
+        except asyncio.CancelledError:
+            result = job_result(record["name"], "cancelled", None, "Cancelled", record["started"])
+        except Exception as e:
+            result = job_result(record["name"], "failed", None, f"{type(e).__name__}: {e}", record["started"])
+        finally:
+            self.free += 1
+            self.running[record["client"]] -= 1
+            self.finish(record, result)
+            self.dispatch()
+
+    def finish(self, record, result):
+        record["state"] = "done"
+        record["result"] = result
+        record["done"].set()
+        if record.get("abandoned"):
+            del self.jobs[record["id"]]
+
+    def cancel(self, job_id):
+        """Drop a queued job or kill a running one. Returns whether there was anything to cancel."""
+        record = self.jobs.get(job_id)
+        if record is None or record["state"] == "done":
+            return False
+        if record["state"] == "running":
+            record["task"].cancel()
+            return True
+        heap = [entry for entry in self.queued[record["client"]] if entry[2] != job_id]
+        heapq.heapify(heap)
+        if heap:
+            self.queued[record["client"]] = heap
+        else:
+            del self.queued[record["client"]]
+        self.finish(record, job_result(record["name"], "cancelled", None, "Cancelled", record["submitted"]))
+        return True
+
+    def status(self):
+        """Describe the slots, the queue depth per submitting process, and the running jobs."""
+        now = time.monotonic()
+        return {
+            "workers": self.workers,
+            "free": self.free,
+            "queued": {str(client): len(heap) for client, heap in self.queued.items()},
+            "running": [{"id": record["id"], "client": record["client"],
+                         "name": record["name"], "seconds": now - record["started"]}
+                        for record in self.jobs.values() if record["state"] == "running"],
+            "unfetched": sum(record["state"] == "done" for record in self.jobs.values()),
+        }
+
+    async def stream_results(self, job_ids, reader, writer, cancel_on_disconnect):
+        """Send each result as its job finishes, and forget the job once it is sent.
+
+        With cancel_on_disconnect the jobs not yet finished are cancelled when
+        the submitter goes away, so killing a script kills its jobs too.
+        """
+        waits = {}
+        for job_id in job_ids:
+            if job_id in self.jobs:
+                waits[asyncio.ensure_future(self.jobs[job_id]["done"].wait())] = job_id
+            else:
+                send(writer, {"id": job_id, "error": "unknown job"})
+        disconnect = asyncio.ensure_future(reader.read())
+        try:
+            while waits:
+                done, _ = await asyncio.wait(set(waits) | {disconnect}, return_when=asyncio.FIRST_COMPLETED)
+                if disconnect in done:
+                    if cancel_on_disconnect:
+                        for job_id in waits.values():
+                            self.jobs[job_id]["abandoned"] = True
+                            self.cancel(job_id)
+                    return
+                for wait in done:
+                    job_id = waits.pop(wait)
+                    send(writer, {"id": job_id, "result": self.jobs.pop(job_id)["result"]})
+                await writer.drain()
+        finally:
+            disconnect.cancel()
+            for wait in waits:
+                wait.cancel()
+
+    async def handle(self, reader, writer):
+        """Answer one request, one JSON object per line each way, then close the connection."""
+        pid, uid = peer_process(writer)
+        try:
+            message = json.loads(await reader.readline())
+            if uid != os.getuid():
+                send(writer, {"error": f"user {uid} may not use this daemon"})
+                await writer.drain()
+                return
+            op = message.get("op")
+            if op in ("run", "submit"):
+                env = message.get("env") or {}
+                job_ids = [self.submit(pid, {**job, "env": {**env, **(job.get("env") or {})}},
+                                       message.get("priority"), message.get("timeout"))
+                           for job in message["jobs"]]
+                self.dispatch()
+                if op == "run":
+                    await self.stream_results(job_ids, reader, writer, cancel_on_disconnect=True)
+                else:
+                    send(writer, {"ids": job_ids})
+            elif op == "wait":
+                await self.stream_results(message["ids"], reader, writer, cancel_on_disconnect=False)
+            elif op == "poll":
+                finished = [job_id for job_id in message["ids"] if self.jobs.get(job_id, {}).get("state") == "done"]
+                send(writer, {"results": {job_id: self.jobs.pop(job_id)["result"] for job_id in finished},
+                              "pending": [job_id for job_id in message["ids"] if job_id in self.jobs]})
+            elif op == "cancel":
+                send(writer, {"cancelled": [job_id for job_id in message["ids"] if self.cancel(job_id)]})
+            elif op == "status":
+                send(writer, self.status())
+            else:
+                send(writer, {"error": f"unknown request {op!r}"})
+            await writer.drain()
+        except (ValueError, KeyError, TypeError) as e:
+            send(writer, {"error": f"bad request: {e}"})
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+def is_listening(socket_path):
+    with socket.socket(socket.AF_UNIX) as sock:
+        try:
+            sock.connect(socket_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return False
+    return True
+
+async def serve_async(socket_path, daemon):
+    if is_listening(socket_path):
+        raise RuntimeError(f"A job daemon is already listening on {socket_path}")
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)  # Left behind by a daemon that did not shut down cleanly
+    old_umask = os.umask(0o077)
+    try:
+        server = await asyncio.start_unix_server(daemon.handle, socket_path, limit=LINE_LIMIT)
+    finally:
+        os.umask(old_umask)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    print(f"Job daemon with {daemon.workers} slots listening on {socket_path}")
+    try:
+        await stop.wait()
+    finally:
+        daemon.stopping = True
+        server.close()
+        os.unlink(socket_path)
+        tasks = [record["task"] for record in daemon.jobs.values() if record["state"] == "running"]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        print(f"Job daemon stopped, {len(tasks)} running jobs killed")
+
+def serve(socket_path=DAEMON_SOCKET, workers=None, timeout=None, pin=False, numa_node=None):
+    """Run the daemon until SIGINT or SIGTERM, which kill the jobs still running."""
+    workers = workers or len(os.sched_getaffinity(0))
+    cpu_pool = core_sets(workers, numa_node) if pin else None
+    asyncio.run(serve_async(socket_path, JobDaemon(workers, timeout, cpu_pool)))
+
+def request(message, socket_path=DAEMON_SOCKET):
+    """Send one request to the daemon and yield its replies until it closes the connection."""
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(message) + "\n").encode())
+        with sock.makefile("r") as replies:
+            for line in replies:
+                reply = json.loads(line)
+                if "error" in reply and "id" not in reply:
+                    raise RuntimeError(f"Job daemon at {socket_path}: {reply['error']}")
+                yield reply
+
+def daemon_status(socket_path=DAEMON_SOCKET):
+    return next(request({"op": "status"}, socket_path))
+
+async def run_on_daemon(job, socket_path=DAEMON_SOCKET, timeout=None, priority=None):
+    """Run one job on the daemon and return its result, as run_job would.
+
+    Cancelling the waiting task closes the connection, which makes the
+    daemon kill the job, so the job dies with its submitter.
+    """
+    reader, writer = await asyncio.open_unix_connection(socket_path, limit=LINE_LIMIT)
+    try:
+        send(writer, job_request("run", [job], timeout, priority))
+        await writer.drain()
+        line = await reader.readline()
+    finally:
+        writer.close()
+    if not line:
+        raise ConnectionError(f"Job daemon at {socket_path} closed the connection")
+    reply = json.loads(line)
+    if "result" not in reply:
+        raise RuntimeError(f"Job daemon at {socket_path}: {reply['error']}")
+    return reply["result"]
+
+def run_on_daemon_sync(job, socket_path=DAEMON_SOCKET, timeout=None):
+    """Run one job on the daemon from synchronous code."""
+    return asyncio.run(run_on_daemon(job, socket_path, timeout))
+
+def command_jobs(commands):
+    """Turn command lines, as in the commands_*.txt files, into shell jobs run from here."""
+    return [{"name": command.strip(), "args": ["sh", "-c", command.strip()]}
+            for command in commands if command.strip()]
+
+def print_result(result):
+    print(f"{result['status']} in {result['wall']:.1f} s wall: {result['name']}")
+    if result["stderr"]:
+        print(f"Errors from {result['name']}:\n{result['stderr']}")
+
+def print_status(status):
+    queued = sum(status["queued"].values())
+    print(f"{status['workers'] - status['free']} of {status['workers']} slots busy, {queued} jobs queued, "
+          f"{status['unfetched']} results not yet fetched")
+    for client, count in sorted(status["queued"].items()):
+        print(f"  process {client}: {count} queued")
+    for job in status["running"]:
+        print(f"  job {job['id']} of process {job['client']} running {job['seconds']:.0f} s: {job['name']}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Node-wide job daemon shared by the pipeline scripts.")
+    parser.add_argument("--socket", default=DAEMON_SOCKET,
+                        help=f"socket of the daemon (default {DAEMON_SOCKET})")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    serve_parser = subparsers.add_parser("serve", help="own this node's worker slots until stopped")
+    serve_parser.add_argument("--workers", type=int, default=None,
+                              help="jobs to run at once (default: one per usable CPU)")
+    serve_parser.add_argument("--timeout", type=float, default=None,
+                              help="seconds before a job submitted without a timeout is killed")
+    serve_parser.add_argument("--pin", action="store_true",
+                              help="pin each running job to its own set of cores")
+    serve_parser.add_argument("--numa-node", type=int, default=None,
+                              help="with --pin, keep every job on the cores of this NUMA node")
+    submit_parser = subparsers.add_parser("submit", help="run the lines of command files as jobs")
+    submit_parser.add_argument("command_files", nargs="+")
+    submit_parser.add_argument("--wait", action="store_true",
+                               help="wait for the jobs, killing them if interrupted, instead of printing their ids")
+    submit_parser.add_argument("--timeout", type=float, default=None,
+                               help="seconds before a command is killed")
+    for action, text in [("wait", "wait for submitted jobs and print their results"),
+                         ("poll", "print the results of finished jobs and the ids still pending"),
+                         ("cancel", "drop queued jobs and kill running ones")]:
+        subparsers.add_parser(action, help=text).add_argument("ids", nargs="+", type=int)
+    subparsers.add_parser("status", help="show the slots in use, queue depth and running jobs")
+    args = parser.parse_args()
+
+    if args.action == "serve":
+        serve(args.socket, args.workers, args.timeout, args.pin, args.numa_node)
+    elif args.action == "submit":
+        commands = []
+        for command_file in args.command_files:
+            with open(command_file, "r") as f:
+                commands.extend(f.readlines())
+        message = job_request("run" if args.wait else "submit", command_jobs(commands), args.timeout)
+        failed = 0
+        for reply in request(message, args.socket):
+            if "ids" in reply:
+                print(f"Submitted {len(reply['ids'])} jobs to {args.socket}")
+                print(" ".join(map(str, reply["ids"])))
+            else:
+                print_result(reply["result"])
+                failed += reply["result"]["status"] != "completed"
+        sys.exit(1 if failed else 0)
+    elif args.action == "wait":
+        for reply in request({"op": "wait", "ids": args.ids}, args.socket):
+            if "error" in reply:
+                print(f"Job {reply['id']}: {reply['error']}")
+            else:
+                print_result(reply["result"])
+    elif args.action == "poll":
+        reply = next(request({"op": "poll", "ids": args.ids}, args.socket))
+        for result in reply["results"].values():
+            print_result(result)
+        print(f"{len(reply['pending'])} jobs pending: {' '.join(map(str, reply['pending']))}")
+    elif args.action == "cancel":
+        reply = next(request({"op": "cancel", "ids": args.ids}, args.socket))
+        print(f"Cancelled {len(reply['cancelled'])} jobs")
+    else:
+        print_status(daemon_status(args.socket))
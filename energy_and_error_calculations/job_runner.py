@@ -0,0 +1,442 @@
+import os
+import sys
+import time
+import signal
+import heapq
+import asyncio
+import itertools
+import resource
+import hashlib
+import tempfile
+import importlib
+import threading
+import traceback
+import subprocess
+from contextlib import contextmanager, asynccontextmanager
+from collections import namedtuple
+
+# Bytes of stderr kept per job, the rest of the stream is dropped
+STDERR_TAIL = 64 * 1024
+
+# Heavy imports loaded once by each warm worker, missing ones are ignored
+PRELOAD_MODULES = ["numpy", "scipy", "scipy.linalg", "scipy.stats"]
+
+# Compiled scripts kept by a warm worker, keyed by the hash of their source
+_script_cache = {}
+
+# Seconds between rereads of MemAvailable while a job waits for memory
+MEMORY_POLL = 5
+
+# Seconds a job waiting for memory may be overtaken by smaller jobs that fit before they are held back for it
+MEMORY_BACKFILL_LIMIT = 600
+
+# Thread counts of OpenMP and the BLAS libraries, set per job to the cores it is pinned to
+THREAD_ENV_VARS = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]
+
+def parse_cpulist(text):
+    """Turn a kernel CPU list such as "0-3,8-11" into a set of CPU numbers."""
+    cpus = set()
+    for part in text.strip().split(","):
+        if part:
+            first, _, last = part.partition("-")
+            cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+def usable_cpus(numa_node=None):
+    """Return the CPUs this process may run on, only those of one NUMA node if given."""
+    cpus = os.sched_getaffinity(0)
+    if numa_node is not None:
+        with open(f"/sys/devices/system/node/node{numa_node}/cpulist", "r") as f:
+            cpus &= parse_cpulist(f.read())
+        if not cpus:
+            raise ValueError(f"No usable CPUs on NUMA node {numa_node}")
+    return sorted(cpus)
+
+def core_sets(workers, numa_node=None):
+    """Split the usable CPUs into one disjoint, equally sized core set per worker.
+
+    With fewer CPUs than workers, workers share single CPUs in turn.
+    """
+    cpus = usable_cpus(numa_node)
+    if len(cpus) < workers:
+        print(f"Warning: {workers} workers on {len(cpus)} CPUs, pinned workers will share cores")
+        return [{cpus[i % len(cpus)]} for i in range(workers)]
+    per_worker = len(cpus) // workers
+    return [set(cpus[i * per_worker:(i + 1) * per_worker]) for i in range(workers)]
+
+def thread_env(threads):
+    """Environment variables limiting OpenMP/BLAS threads to the given count."""
+    return {var: str(threads) for var in THREAD_ENV_VARS}
+
+@contextmanager
+def pinned(cpus):
+    """Restrict the calling thread to cpus while processes are started, so they inherit it."""
+    if not cpus:
+        yield
+        return
+    saved = os.sched_getaffinity(0)
+    os.sched_setaffinity(0, cpus)
+    try:
+        yield
+    finally:
+        os.sched_setaffinity(0, saved)
+
+def read_tail(file, size=STDERR_TAIL):
+    """Read at most the last size bytes of an open binary file as text."""
+    file.seek(0, os.SEEK_END)
+    file.seek(max(0, file.tell() - size))
+    return file.read().decode(errors="replace")
+
+def kill_job(process):
+    """Kill a job together with any children it started."""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+def job_result(name, status, returncode, stderr, start, usage=None):
+    """Build the result of a job, with the CPU time and peak memory it used if known.
+
+    usage is an object with the ru_utime, ru_stime and ru_maxrss fields of
+    resource.getrusage, ru_maxrss being in kilobytes as on Linux.
+    """
+    return {
+        "name": name,
+        "status": status,
+        "returncode": returncode,
+        "stderr": stderr,
+        "wall": time.monotonic() - start,
+        "user": usage.ru_utime if usage else None,
+        "sys": usage.ru_stime if usage else None,
+        "max_rss_kb": usage.ru_maxrss if usage else None,
+    }
+
+def wait_in_thread(loop, pid):
+    """Reap a child in its own thread and hand its wait status and rusage to the event loop.
+
+    Each job gets a dedicated thread so a long job never delays noticing that
+    a short one has finished.
+    """
+    future = loop.create_future()
+
+    def reap():
+        _, wait_status, usage = os.wait4(pid, 0)
+        loop.call_soon_threadsafe(future.set_result, (wait_status, usage))
+
+    threading.Thread(target=reap, daemon=True).start()
+    return future
+
+class PrioritySlots:
+    """Job slots handed out lowest priority value first, instead of in arrival order.
+
+    Use "async with slots.at(priority)" around a job; plain "async with
+    slots" waits behind every prioritised job.
+    """
+
+    def __init__(self, slots):
+        self.free = slots
+        self.waiters = []
+        self.order = itertools.count()
+
+    async def acquire(self, priority):
+        if self.free > 0 and not self.waiters:
+            self.free -= 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.order), waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()  # Handed a slot just as it was cancelled
+            raise
+
+    def release(self):
+        while self.waiters:
+            _, _, waiter = heapq.heappop(self.waiters)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.free += 1
+
+    @asynccontextmanager
+    async def at(self, priority):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def idle(self):
+        """Check for a free slot that no job is waiting for."""
+        return self.free > 0 and all(waiter.done() for _, _, waiter in self.waiters)
+
+    async def __aenter__(self):
+        await self.acquire((float("inf"),))
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+def mem_available_kb():
+    """Return MemAvailable from /proc/meminfo, in kilobytes."""
+    with open("/proc/meminfo", "r") as f:
+        for line in f:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1])
+    raise OSError("No MemAvailable line in /proc/meminfo")
+
+class MemoryGate:
+    """Admit jobs while their projected memory fits under a fraction of MemAvailable.
+
+    Admitted jobs are assumed to use their projection, so the budget is the
+    fraction of MemAvailable plus what is already reserved, capped at the
+    fraction of MemAvailable seen when nothing was running, as jobs that
+    have just started have not grown yet. Waiting jobs are considered
+    lowest priority value first, then in arrival order, and every one that
+    fits is admitted, so small jobs backfill around a large one that does
+    not fit yet. Once a job has waited backfill_limit seconds, the jobs
+    behind it are held back until it is admitted, so it cannot be starved.
+    Waiting jobs are checked again whenever a job finishes and every
+    MEMORY_POLL seconds. A job is always admitted when nothing else is
+    running.
+    """
+
+    def __init__(self, fraction, backfill_limit=MEMORY_BACKFILL_LIMIT):
+        self.fraction = fraction
+        self.backfill_limit = backfill_limit
+        self.reserved = 0
+        self.running = 0
+        self.idle_available = None
+        # Waiting jobs, as a heap of (priority, order, need_kb, waiting since, future)
+        self.waiters = []
+        self.order = itertools.count()
+
+    def grant(self):
+        """Admit every waiting job that fits, in priority order, up to the first starved one that does not."""
+        available = mem_available_kb()
+        now = time.monotonic()
+        waiting = []
+        starved = False
+        for entry in sorted(self.waiters):
+            _, _, need_kb, since, future = entry
+            if future.done():
+                continue  # Cancelled while waiting
+            if not starved:
+                if self.running == 0:
+                    self.idle_available = available
+                    fits = True
+                else:
+                    fits = self.reserved + need_kb <= self.fraction * min(available + self.reserved,
+                                                                          self.idle_available)
+                if fits:
+                    self.reserved += need_kb
+                    self.running += 1
+                    future.set_result(None)
+                    continue
+                starved = now - since >= self.backfill_limit
+            waiting.append(entry)
+        self.waiters = waiting  # Still sorted, so still a heap
+
+    async def admit(self, need_kb, priority=(float("inf"),)):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (tuple(priority), next(self.order), need_kb, time.monotonic(), future))
+        self.grant()
+        try:
+            while not future.done():
+                try:
+                    await asyncio.wait_for(asyncio.shield(future), MEMORY_POLL)
+                except asyncio.TimeoutError:
+                    if self.waiters and self.waiters[0][-1] is future:
+                        self.grant()  # Check again, memory may have been freed outside this run
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                await self.release(need_kb)  # Admitted just as it was cancelled
+            else:
+                future.cancel()
+                self.grant()  # The jobs behind it may fit now
+            raise
+
+    async def release(self, need_kb):
+        self.reserved -= need_kb
+        self.running -= 1
+        self.grant()
+
+async def run_job(job, semaphore=None, timeout=None, cpu_pool=None):
+    """Run one external tool and wait for it without blocking the event loop.
+
+    A job is a dict with the command "args", its "cwd", and optionally a
+    "stdin" file, a short "input" string, a "stdout" file and extra "env"
+    variables. stdout goes straight to the file and only the tail of stderr
+    is kept, so nothing grows in memory. A job still running after timeout
+    seconds is killed with its process group and returned with the status
+    "timeout", and a job whose task is cancelled is killed the same way
+    before the cancellation goes on. A tool that cannot be started, or whose
+    stdin or stdout file cannot be opened, is returned as "failed" with the
+    error as stderr. With a cpu_pool, a list of core sets with one per
+    semaphore slot, the job is pinned to a free core set for its lifetime
+    and its OpenMP/BLAS threads default to the size of that set.
+    """
+    if semaphore is None:
+        return await run_pooled_job(job, timeout, cpu_pool)
+    async with semaphore:
+        return await run_pooled_job(job, timeout, cpu_pool)
+
+async def run_pooled_job(job, timeout, cpu_pool):
+    """Run one job on a core set taken from the cpu_pool, if there is one."""
+    cpus = cpu_pool.pop() if cpu_pool else None
+    try:
+        return await run_pinned_job(job, timeout, cpus)
+    finally:
+        if cpus:
+            cpu_pool.append(cpus)
+
+async def run_pinned_job(job, timeout, cpus):
+    """Run one job, pinned to the cpus if given."""
+    loop = asyncio.get_running_loop()
+    start = time.monotonic()
+    env = None
+    if cpus or job.get("env"):
+        env = dict(os.environ)
+        if cpus:
+            env.update(thread_env(len(cpus)))
+        env.update(job.get("env") or {})
+    stdin, stdout = subprocess.PIPE, subprocess.DEVNULL
+    with tempfile.TemporaryFile() as stderr:
+        try:
+            if job.get("stdin"):
+                stdin = open(job["stdin"], "rb")
+            if job.get("stdout"):
+                stdout = open(job["stdout"], "wb")
+            with pinned(cpus):
+                process = subprocess.Popen(
+                    job["args"],
+                    stdin=stdin,
+                    stdout=stdout,
+                    stderr=stderr,
+                    cwd=job.get("cwd"),
+                    env=env,
+                    start_new_session=True
+                )
+        except OSError as e:
+            return job_result(job.get("name", job["args"][0]), "failed", None, str(e), start)
+        finally:
+            if stdin is not subprocess.PIPE:
+                stdin.close()
+            if stdout is not subprocess.DEVNULL:
+                stdout.close()
+        if process.stdin:
+            try:
+                process.stdin.write(job.get("input", "").encode())
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+        waiter = wait_in_thread(loop, process.pid)
+        status = "completed"
+        try:
+            wait_status, usage = await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except asyncio.TimeoutError:
+            kill_job(process)
+            wait_status, usage = await waiter
+            status = "timeout"
+        except asyncio.CancelledError:
+            kill_job(process)
+            await waiter
+            raise
+        returncode = os.waitstatus_to_exitcode(wait_status)
+        process.returncode = returncode
+        if status != "timeout" and returncode != 0:
+            status = "failed"
+
+        return job_result(job.get("name", job["args"][0]), status, returncode,
+                          read_tail(stderr), start, usage)
+
+def run_job_sync(job, timeout=None):
+    """Run one job to completion from synchronous code."""
+    return asyncio.run(run_job(job, timeout=timeout))
+
+def preload_imports(modules=None):
+    """Import the heavy modules the AutoLD/AutoFree scripts need, once per worker."""
+    for module in modules or PRELOAD_MODULES:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+
+def load_script(path):
+    """Compile a script once per worker and reuse it for identical copies."""
+    with open(path, "rb") as f:
+        source = f.read()
+    digest = hashlib.sha256(source).hexdigest()
+    if digest not in _script_cache:
+        _script_cache[digest] = compile(source, str(path), "exec")
+    return _script_cache[digest]
+
+ScriptUsage = namedtuple("ScriptUsage", ["ru_utime", "ru_stime", "ru_maxrss"])
+
+def raise_timeout(signum, frame):
+    raise TimeoutError
+
+def run_script_job(job, timeout=None):
+    """Run a "python script.py ..." job inside this process instead of a new interpreter.
+
+    Meant for warm pool workers started with preload_imports. The script runs
+    as __main__ with the job's cwd as the working directory and with
+    sys.argv set from the job. Its stdout, including output written by C
+    extensions, goes to the job's stdout file and the tail of its stderr is
+    kept as for a subprocess. A script still running after
+    timeout seconds is interrupted and reported as "timeout". CPU time is the
+    worker's own plus that of any children the script waited for; the peak
+    RSS is the worker's, which includes the preloaded modules. Never call this
+    from the orchestrating process, as the script shares its interpreter.
+    """
+    start = time.monotonic()
+    usage_before = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    script = os.path.join(job.get("cwd") or ".", job["args"][1])
+    name = job.get("name", job["args"][1])
+    old_cwd = os.getcwd()
+    old_argv = sys.argv
+    saved_stdout, saved_stderr = os.dup(1), os.dup(2)
+    status, returncode, error = "completed", 0, ""
+    stdout = open(job["stdout"], "wb") if job.get("stdout") else open(os.devnull, "wb")
+    stderr = tempfile.TemporaryFile()
+    try:
+        code = load_script(script)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(stdout.fileno(), 1)
+        os.dup2(stderr.fileno(), 2)
+        os.chdir(job.get("cwd") or ".")
+        sys.argv = job["args"][1:]
+        if timeout:
+            signal.signal(signal.SIGALRM, raise_timeout)
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+        exec(code, {"__name__": "__main__", "__file__": os.path.abspath(job["args"][1])})
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            status, returncode = "failed", e.code if isinstance(e.code, int) else 1
+    except TimeoutError:
+        status, returncode = "timeout", -signal.SIGALRM
+    except BaseException:
+        status, returncode, error = "failed", 1, traceback.format_exc()
+    finally:
+        if timeout:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved_stdout, 1)
+        os.dup2(saved_stderr, 2)
+        os.close(saved_stdout)
+        os.close(saved_stderr)
+        stdout.close()
+        os.chdir(old_cwd)
+        sys.argv = old_argv
+    with stderr:
+        error = (read_tail(stderr) + error)[-STDERR_TAIL:]
+    usage_after = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    usage = ScriptUsage(
+        sum(after.ru_utime - before.ru_utime for before, after in zip(usage_before, usage_after)),
+        sum(after.ru_stime - before.ru_stime for before, after in zip(usage_before, usage_after)),
+        max(after.ru_maxrss for after in usage_after),
+    )
+    return job_result(name, status, returncode, error, start, usage)
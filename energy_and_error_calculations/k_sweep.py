@@ -0,0 +1,264 @@
+'''
+Run a k-point convergence study in the crystal-files/<crystal>/<polymorph>/calc/k_value_X/ layout
+read by generating-all-data.py and timing-collection.py, without redoing the k-independent work
+for every k.
+
+neighcrys, the SPLI removal and the dmacrys run on the undisplaced .res.dmain do not depend on the
+k-point spacing, so they run once per polymorph in calc/setup/. Their outputs are then placed in
+each calc/k_value_X/ folder, and only AutoLD.py -k X, the displaced dmacrys runs and AutoFree.py
+run once per k. The jobs of every polymorph and k share the same worker slots, and finished
+folders are skipped when the sweep is run again.
+
+With --converge TOL each polymorph instead starts at the coarsest spacing and only moves on to
+the next finer one while its "Energy with Debye and KDE" (as computed by generating-all-data.py)
+changes by more than TOL between successive spacings. The spacing it converged at is written to
+calc/k-convergence.json and, for all polymorphs, to CONVERGENCE_CSV.
+
+Usage:
+    python k_sweep.py [--base-dir crystal-files] [--k 0.10 0.15 ...] [--workers N] [--timeout SECONDS]
+                      [--converge TOL] [--compress [FORMAT]]
+'''
+
+import os
+import csv
+import json
+import asyncio
+import argparse
+from pathlib import Path
+
+import calculations
+from calculations import (
+    BONDLENGTHS_PATH, FITPOTS_PATH, DMA_SOURCE_DIR, SCRIPTS_TO_COPY, PipelineRun, store_input,
+    link_input, write_fort22, load_manifest, mark_step_done, next_step, check_inputs, remove_spli_lines,
+    is_dmain_pending, make_k_folder, run_folder_job, run_dmacrys_job, run_structure, report_cache,
+    report_counts, report_speculation, structure_name, is_pruned, check_daemon, DEFAULT_DAEMON_SOCKET,
+)
+from output_compression import open_output, compress_outputs
+
+BASE_DIR = "crystal-files"
+K_VALUES = [f"{i/100:.2f}" for i in range(10, 45, 5)]  # 0.10 to 0.40, as in out-file-collector.py
+SETUP_NAME = "setup"  # Folder under calc/ holding the k-independent steps of a polymorph
+CONVERGENCE_NAME = "k-convergence.json"  # Energies per k and the converged spacing, in calc/
+CONVERGENCE_CSV = "k-convergence.csv"  # Converged spacing of every polymorph, written after a --converge run
+
+def find_res_file(polymorph):
+    """Return the .res file of a polymorph, from its own folder or its calc folder."""
+    for folder in [polymorph, polymorph / "calc"]:
+        res_files = sorted(folder.glob("*.res"))
+        if res_files:
+            return res_files[0]
+    return None
+
+def prepare_setup(crystal, polymorph):
+    """Create calc/setup/ for a polymorph with its inputs and fort.22, or return None."""
+    res_file = find_res_file(polymorph)
+    if res_file is None:
+        print(f"Skipping {crystal.name}/{polymorph.name}: no .res file found")
+        return None
+    setup = polymorph / "calc" / SETUP_NAME
+    setup.mkdir(parents=True, exist_ok=True)
+    inputs = {
+        res_file.name: res_file,
+        "bondlengths": BONDLENGTHS_PATH,
+        "fit.pots": FITPOTS_PATH,
+        f"{crystal.name}.dma": os.path.join(DMA_SOURCE_DIR, f"{crystal.name}.dma"),
+        f"{crystal.name}.mols": os.path.join(DMA_SOURCE_DIR, f"{crystal.name}.mols"),
+    }
+    for name, path in inputs.items():
+        if not os.path.exists(path):
+            print(f"Skipping {crystal.name}/{polymorph.name}: missing {name} at {path}")
+            return None
+    for name, path in inputs.items():
+        link_input(store_input(path), setup / name)
+    if not load_manifest(setup):
+        write_fort22(setup, res_file.stem, crystal.name)
+    return setup
+
+async def run_setup(setup, run):
+    """Run neighcrys, the SPLI removal and the undisplaced dmacrys job once for a polymorph."""
+    if next_step(setup) == "neighcrys":
+        message = check_inputs(setup, "neighcrys")
+        status = "skipped" if message else await run_folder_job(setup, "neighcrys", run)
+        run.counts["neighcrys"][status] += 1
+        if status != "completed":
+            print(message or f"Stopping {setup.parent.parent.name}: neighcrys {status}")
+            return False
+        mark_step_done(setup, "neighcrys")
+    dmain_file = setup / f"{calculations.structure_name(setup)}.res.dmain"
+    if next_step(setup) == "spli":
+        remove_spli_lines(dmain_file)
+        mark_step_done(setup, "spli")
+    if is_dmain_pending(dmain_file):
+        status = await run_dmacrys_job(dmain_file, run)
+        if status != "completed":
+            print(f"Stopping {setup.parent.parent.name}: dmacrys {status}")
+            return False
+    return True
+
+def fan_out(setup, k_value):
+    """Give a k folder the setup outputs and scripts, with neighcrys and SPLI marked as done."""
+    k_dir = make_k_folder(setup, k_value)
+    if is_pruned(k_dir):
+        return k_dir
+    for script in SCRIPTS_TO_COPY:
+        link_input(store_input(script), k_dir / Path(script).name)
+    return k_dir
+
+def energy_with_debye_and_kde(out_file):
+    """Return the "Energy with Debye and KDE" of an AutoFree .out file, or None if it has none."""
+    values = {}
+    try:
+        with open_output(out_file) as f:
+            for line in f:
+                if "Debye contribution to vibrational energy:" in line:
+                    values["debye"] = float(line.split(":")[1].split()[0])
+                elif "Total number of phonons is:" in line:
+                    values["phonons"] = int(line.split(":")[1].strip())
+                elif "Epanechnikov KDE vibrational energy:" in line:
+                    values["kde"] = float(line.split(":")[1].split()[0])
+    except OSError:
+        return None
+    if "kde" not in values:
+        return None
+    phonons = values.get("phonons", 0)
+    scale_factor = (phonons - 3) / phonons if phonons > 0 else 1
+    return values["kde"] * scale_factor + values.get("debye", 0)
+
+def write_convergence(setup, record):
+    path = setup.parent / CONVERGENCE_NAME
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(record, f, indent=2)
+    os.replace(tmp_path, path)
+
+async def converge_polymorph(setup, k_values, tolerance, run):
+    """Run one k at a time from coarse to fine until the energy changes by no more than tolerance.
+
+    The converged spacing is the coarser of the first two successive
+    spacings that agree, as the finer one only confirmed it.
+    """
+    record = {"tolerance": tolerance, "energies": {}, "converged k": None}
+    previous = None
+    for k_value in sorted(k_values, key=float, reverse=True):
+        k_dir = fan_out(setup, k_value)
+        await run_structure(k_dir, run)
+        energy = energy_with_debye_and_kde(k_dir / f"{structure_name(k_dir)}.out")
+        if energy is None:
+            print(f"Stopping {setup.parent.parent.name} at k = {k_value}: no energy in its .out file")
+            break
+        record["energies"][k_value] = energy
+        if previous is not None and abs(energy - record["energies"][previous]) <= tolerance:
+            record["converged k"] = previous
+            break
+        previous = k_value
+    write_convergence(setup, record)
+    if record["converged k"]:
+        print(f"{setup.parent.parent.name} converged at k = {record['converged k']}")
+    return record
+
+async def run_polymorph(setup, k_values, run, tolerance=None):
+    """Run the setup of a polymorph once, then AutoLD, dmacrys and AutoFree for every k.
+
+    With a tolerance the k values are run one at a time until converged.
+    """
+    if not await run_setup(setup, run):
+        return None
+    if tolerance is not None:
+        return await converge_polymorph(setup, k_values, tolerance, run)
+    k_dirs = [fan_out(setup, k_value) for k_value in k_values]
+    await asyncio.gather(*(run_structure(k_dir, run) for k_dir in k_dirs))
+    return None
+
+async def run_sweep_async(setups, k_values, workers, tolerance=None):
+    run = PipelineRun(workers, calculations.WARM_SCRIPTS)
+    try:
+        records = await asyncio.gather(*(run_polymorph(setup, k_values, run, tolerance) for setup in setups))
+    finally:
+        run.close()
+    report_cache(run)
+    report_speculation(run)
+    return run.counts, records
+
+def write_convergence_summary(setups, records, csv_path=CONVERGENCE_CSV):
+    """Write the converged spacing and its energy for every polymorph of a --converge run."""
+    with open(csv_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Crystal", "Polymorph", "Converged K-Point", "Energy with Debye and KDE",
+                         "K-Points Run"])
+        for setup, record in zip(setups, records):
+            polymorph = setup.parent.parent
+            converged = (record or {}).get("converged k")
+            energies = (record or {}).get("energies", {})
+            writer.writerow([polymorph.parent.name, polymorph.name, converged or "not converged",
+                             f"{energies[converged]:.6f}" if converged else "", " ".join(energies)])
+    print(f"Converged spacings written to {csv_path}")
+
+def run_k_sweep(base_dir=BASE_DIR, k_values=K_VALUES, workers=None, tolerance=None, compress=None):
+    """Run every polymorph below base_dir at every k-point spacing in k_values.
+
+    With a tolerance, each polymorph stops at the spacing where its energy
+    has converged instead. With compress, a format name or "" for the
+    first available, the finished outputs are compressed afterwards.
+    """
+    for script in SCRIPTS_TO_COPY:
+        if not os.path.exists(script):
+            raise FileNotFoundError(f"Missing script: {script}")
+    setups = []
+    for crystal in sorted(Path(base_dir).iterdir()):
+        if crystal.is_dir():
+            for polymorph in sorted(crystal.iterdir()):
+                if polymorph.is_dir():
+                    setup = prepare_setup(crystal, polymorph)
+                    if setup is not None:
+                        setups.append(setup)
+    print(f"Sweeping {len(setups)} polymorphs over k = {', '.join(k_values)}")
+    counts, records = asyncio.run(run_sweep_async(setups, k_values, workers or calculations.WORKERS, tolerance))
+    report_counts(counts)
+    if tolerance is not None:
+        write_convergence_summary(setups, records)
+    if compress is not None:
+        compress_outputs([base_dir], compress or None)
+    print("k sweep completed")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a k-point convergence sweep, sharing the k-independent steps.")
+    parser.add_argument("--base-dir", default=BASE_DIR,
+                        help="folder holding <crystal>/<polymorph> folders")
+    parser.add_argument("--k", nargs="+", default=K_VALUES, metavar="SPACING",
+                        help="k-point spacings to run AutoLD.py with")
+    parser.add_argument("--workers", type=int, default=calculations.WORKERS,
+                        help="external tools to run at once")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="seconds before a job is killed")
+    parser.add_argument("--warm", action="store_true",
+                        help="run AutoLD.py and AutoFree.py in warm worker processes")
+    parser.add_argument("--dmacrys-cache", nargs="?", const="dmacrys-cache", default=None,
+                        metavar="DIR",
+                        help="reuse the .dmaout of identical dmacrys inputs across k, cached in DIR")
+    parser.add_argument("--pin", action="store_true",
+                        help="pin each concurrent job to its own set of cores")
+    parser.add_argument("--numa-node", type=int, default=None,
+                        help="with --pin, keep every job on the cores of this NUMA node")
+    parser.add_argument("--converge", type=float, default=None, metavar="TOL",
+                        help="go from coarse to fine k only while the Energy with Debye and KDE "
+                             "changes by more than TOL, and record the converged spacing")
+    parser.add_argument("--speculate", nargs="?", type=float, const=calculations.SPECULATE_FACTOR,
+                        default=None, metavar="FACTOR",
+                        help="once slots sit idle, race a duplicate against straggling dmacrys jobs")
+    parser.add_argument("--daemon", nargs="?", const=DEFAULT_DAEMON_SOCKET, default=None, metavar="SOCKET",
+                        help="hand every job to the job daemon on SOCKET, sharing the node with other runs")
+    parser.add_argument("--compress", nargs="?", const="", default=None, metavar="FORMAT",
+                        help="compress the finished .dmaout and .out files afterwards, with zstd, "
+                             "gzip or xz (default: the first available)")
+    args = parser.parse_args()
+    calculations.PIN_CPUS = args.pin
+    calculations.NUMA_NODE = args.numa_node
+    calculations.JOB_TIMEOUT = args.timeout
+    calculations.WARM_SCRIPTS = args.warm
+    calculations.DMACRYS_CACHE = args.dmacrys_cache
+    calculations.SPECULATE = args.speculate is not None
+    calculations.SPECULATE_FACTOR = args.speculate or calculations.SPECULATE_FACTOR
+    calculations.DAEMON_SOCKET = args.daemon
+    if args.daemon:
+        check_daemon(parser, args)
+    run_k_sweep(args.base_dir, args.k, args.workers, args.converge, args.compress)
@@ -1,6 +1,8 @@
 import os
 from collections import defaultdict
 
+from output_compression import plain_name
+
 def check_out_files(root_dir):
     """
     Check if each subdirectory has exactly one .out file.
@@ -12,7 +14,7 @@ def check_out_files(root_dir):
     
     # Walk through the directory tree
     for dirpath, dirnames, filenames in os.walk(root_dir):
-        out_files = [f for f in filenames if f.endswith('.out')]
+        out_files = [f for f in filenames if plain_name(f).endswith('.out')]  # Plain or compressed
         out_count = len(out_files)
         
         # Record directories that have .out files
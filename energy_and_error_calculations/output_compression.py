@@ -0,0 +1,181 @@
+'''
+Compress finished dmacrys .dmaout and AutoFree .out files in place, and open them again without
+caring whether they are stored plain or compressed.
+
+A folder counts as finished once its AutoFree .out file has the vibrational energy lines, as
+AutoFree is the last tool that reads the .dmaout files next to it. Only outputs that are complete
+themselves are compressed, each into <name>.zst, <name>.gz or <name>.xz, using the first of
+FORMATS that is available here. .dmaout files hardlinked from the dmacrys cache are left alone,
+as compressing them would free nothing.
+
+Usage:
+    python output_compression.py compress <dir> [<dir> ...] [--format zstd|gzip|xz] [--dry-run]
+    python output_compression.py decompress <dir> [<dir> ...]
+'''
+
+import os
+import gzip
+import lzma
+import shutil
+import argparse
+from pathlib import Path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # zstd needs the zstandard package, gzip and xz are always there
+
+FORMATS = ["zstd", "gzip", "xz"]  # Preference order when no format is given
+SUFFIXES = {"zstd": ".zst", "gzip": ".gz", "xz": ".xz"}
+# Raised when reading a truncated or corrupt compressed file
+READ_ERRORS = (OSError, EOFError, lzma.LZMAError) + ((zstandard.ZstdError,) if zstandard else ())
+COMPLETE_MARKERS = {
+    ".dmaout": ["Total run time"],
+    ".out": ["Neat vibrational energy =", "Epanechnikov KDE vibrational energy:"],
+}
+
+def available_formats():
+    """Return the compression formats usable here, in order of preference."""
+    return [fmt for fmt in FORMATS if fmt != "zstd" or zstandard is not None]
+
+def opener(fmt):
+    if fmt == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Reading or writing .zst files needs the zstandard package")
+        return zstandard.open
+    return gzip.open if fmt == "gzip" else lzma.open
+
+def compressed_format(path):
+    """Return the format a file is compressed with, judged by its suffix, or None if plain."""
+    for fmt, suffix in SUFFIXES.items():
+        if str(path).endswith(suffix):
+            return fmt
+    return None
+
+def plain_name(name):
+    """Strip a compression suffix from a file name."""
+    fmt = compressed_format(name)
+    return name[:-len(SUFFIXES[fmt])] if fmt else name
+
+def find_output(path):
+    """Return the plain file at path if there is one, else a compressed copy of it, else None."""
+    path = Path(path)
+    if path.exists():
+        return path
+    for suffix in SUFFIXES.values():
+        candidate = path.with_name(path.name + suffix)
+        if candidate.exists():
+            return candidate
+    return None
+
+def open_output(path):
+    """Open an output file for reading as text, whether it is stored plain or compressed.
+
+    path may be the plain name; a missing file raises FileNotFoundError
+    as open() would.
+    """
+    found = find_output(path) or Path(path)
+    fmt = compressed_format(found)
+    return opener(fmt)(found, "rt") if fmt else open(found, "r")
+
+def is_complete(path):
+    """Check that an output contains the lines a finished run of its tool writes."""
+    markers = COMPLETE_MARKERS.get(Path(plain_name(Path(path).name)).suffix)
+    if not markers:
+        return False
+    try:
+        with open_output(path) as f:
+            content = f.read()
+    except READ_ERRORS:
+        return False
+    return all(marker in content for marker in markers)
+
+def compress_file(path, fmt):
+    """Replace a file by a compressed copy, keeping its mode and times. Returns the new path."""
+    target = path.with_name(path.name + SUFFIXES[fmt])
+    tmp_path = target.with_name(f".{target.name}.tmp")
+    with open(path, "rb") as source, opener(fmt)(tmp_path, "wb") as destination:
+        shutil.copyfileobj(source, destination, 1 << 20)
+    shutil.copystat(path, tmp_path)
+    os.replace(tmp_path, target)
+    os.unlink(path)
+    return target
+
+def decompress_file(path, destination=None):
+    """Write the plain contents of a compressed file to destination, by default its plain name."""
+    destination = Path(destination or path.with_name(plain_name(path.name)))
+    tmp_path = destination.with_name(f".{destination.name}.tmp")
+    with opener(compressed_format(path))(path, "rb") as source, open(tmp_path, "wb") as target:
+        shutil.copyfileobj(source, target, 1 << 20)
+    shutil.copystat(path, tmp_path)
+    os.replace(tmp_path, destination)
+    return destination
+
+def finished_outputs(folder, filenames):
+    """List the plain outputs of a folder that are safe to compress."""
+    if not any(is_complete(folder / name) for name in filenames if plain_name(name).endswith(".out")):
+        return []
+    outputs = []
+    for name in filenames:
+        path = folder / name
+        if (name.endswith((".dmaout", ".out")) and not name.startswith(".")
+                and path.stat().st_nlink == 1 and is_complete(path)):
+            outputs.append(path)
+    return outputs
+
+def compress_outputs(root_dirs, fmt=None, dry_run=False):
+    """Compress the finished outputs below root_dirs and print the space saved.
+
+    With dry_run nothing is written, and the plain size of what would be
+    compressed is reported instead.
+    """
+    fmt = fmt or available_formats()[0]
+    if fmt not in available_formats():
+        raise RuntimeError(f"{fmt} compression is not available here")
+    count, before, after = 0, 0, 0
+    for root_dir in root_dirs:
+        for dirpath, _, filenames in os.walk(root_dir):
+            for path in finished_outputs(Path(dirpath), sorted(filenames)):
+                size = path.stat().st_size
+                count += 1
+                before += size
+                if not dry_run:
+                    after += compress_file(path, fmt).stat().st_size
+    if dry_run:
+        print(f"Would compress {count} finished outputs holding {before / 2**20:.1f} MB with {fmt}")
+    else:
+        print(f"Compressed {count} finished outputs with {fmt}: "
+              f"{before / 2**20:.1f} MB down to {after / 2**20:.1f} MB")
+    return count, before, after
+
+def decompress_outputs(root_dirs):
+    """Restore every compressed output below root_dirs to a plain file."""
+    count = 0
+    for root_dir in root_dirs:
+        for dirpath, _, filenames in os.walk(root_dir):
+            for name in filenames:
+                if compressed_format(name) and plain_name(name).endswith((".dmaout", ".out")):
+                    path = Path(dirpath) / name
+                    decompress_file(path)
+                    os.unlink(path)
+                    count += 1
+    print(f"Decompressed {count} outputs")
+    return count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compress finished .dmaout and .out files in place.")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    compress_parser = subparsers.add_parser("compress", help="compress the outputs of finished folders")
+    compress_parser.add_argument("root_dirs", nargs="+")
+    compress_parser.add_argument("--format", choices=FORMATS, default=None,
+                                 help=f"compression format (default: the first available of {', '.join(FORMATS)})")
+    compress_parser.add_argument("--dry-run", action="store_true",
+                                 help="only report what would be compressed")
+    decompress_parser = subparsers.add_parser("decompress", help="restore compressed outputs to plain files")
+    decompress_parser.add_argument("root_dirs", nargs="+")
+    args = parser.parse_args()
+
+    if args.action == "compress":
+        compress_outputs(args.root_dirs, args.format, args.dry_run)
+    else:
+        decompress_outputs(args.root_dirs)
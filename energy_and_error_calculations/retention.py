@@ -0,0 +1,224 @@
+'''
+Retention policy for finished structure folders. Once AutoFree has written <id>.out, a folder
+only needs its .out file for the energy scripts; the displaced .dmain/.dmaout files, the staged
+potentials and scripts and the neighcrys outputs are intermediates kept for nothing but their
+inodes.
+
+For each finished folder this writes RECORD_NAME with what the analysis scripts read from the
+intermediates: the timing footer of every .dmaout (as timing-collection.py collects them) and the
+energy lines of the .out file. It then deletes the intermediates, or first packs them into
+<archive>/<folder path>.tar.gz with --archive. The files in KEEP stay, among them the .dos file
+holding the frequencies plot_dos_with_debye.py reads. The folder's manifest is marked as pruned,
+so calculations.py treats it as done instead of running it again.
+
+A dry run reports how much space and how many inodes pruning would free. Hardlinked inputs from
+the input store or the dmacrys cache free an inode only with their last link, so they count
+towards neither.
+
+Usage:
+    python retention.py prune <dir> [<dir> ...] [--dry-run] [--archive DIR]
+    python retention.py restore <archive.tar.gz> <folder>
+'''
+
+import os
+import json
+import time
+import tarfile
+import argparse
+from fnmatch import fnmatch
+from pathlib import Path
+
+from calculations import MANIFEST_NAME, QUARANTINE_NAME, load_manifest, is_pruned, structure_name
+from output_compression import open_output, plain_name, is_complete
+
+RECORD_NAME = "phonon-record.json"  # Timings and energies of a pruned folder
+KEEP = ["*.res", "*.out", "*.dos", "fort.22", MANIFEST_NAME, QUARANTINE_NAME, RECORD_NAME]  # Never pruned
+TIMING_METRICS = [
+    "Time to set things up",
+    "Reciprocal space part of Ewald sum",
+    "Real space part of Ewald sum",
+    "Short range potential calculation",
+    "Energy calculation",
+    "First derivative chain rule",
+    "Second derivative chain rule",
+    "All other program sections",
+    "Total run time",
+]  # dmacrys timing footer lines, as read by timing-collection.py
+ENERGY_LINES = {
+    "Neat vibrational energy": "Neat vibrational energy =",
+    "Debye contribution to vibrational energy": "Debye contribution to vibrational energy:",
+    "Epanechnikov KDE vibrational energy": "Epanechnikov KDE vibrational energy:",
+    "Total number of phonons": "Total number of phonons is:",
+    "Total number of sampled unique k-points": "Total number of sampled unique k-points:",
+}  # AutoFree .out lines, as read by collecting-energy-values-from-out-files.py
+
+def dmaout_timings(path):
+    """Read the timing footer of a .dmaout file."""
+    timings = {}
+    with open_output(path) as f:
+        for line in f:
+            for metric in TIMING_METRICS:
+                if metric in line:
+                    timings[metric] = float(line.split()[-1])
+    return timings
+
+def out_energies(path):
+    """Read the energy and phonon count lines of an AutoFree .out file."""
+    energies = {}
+    with open_output(path) as f:
+        for line in f:
+            for name, marker in ENERGY_LINES.items():
+                if marker in line:
+                    value = line.split(marker)[1].split()[0]
+                    energies[name] = int(value) if name.startswith("Total number") else float(value)
+    return energies
+
+def is_finished(folder):
+    """Check that AutoFree has finished in a folder and the manifest, if any, agrees."""
+    manifest = load_manifest(folder)
+    if manifest and "autofree" not in manifest:
+        return False
+    return is_complete(folder / f"{structure_name(folder)}.out")
+
+def intermediates(folder):
+    """List the files of a folder that pruning would remove."""
+    return sorted(path for path in folder.iterdir()
+                  if (path.is_file() or path.is_symlink())
+                  and not any(fnmatch(plain_name(path.name), pattern) for pattern in KEEP))
+
+def reclaimable(paths):
+    """Return the bytes and inodes deleting paths frees, counting only their last links."""
+    size, inodes = 0, 0
+    for path in paths:
+        info = path.lstat()
+        if info.st_nlink == 1:
+            size += info.st_size
+            inodes += 1
+    return size, inodes
+
+def write_record(folder, paths, archive=None):
+    """Write the timings and energies the analysis scripts need into the folder's record.
+
+    The k-point spacing comes from the manifest, as the run's --k-spacing is
+    not known here, and is None for folders run before it was recorded.
+    """
+    name = structure_name(folder)
+    record = {
+        "structure": name,
+        "k spacing": load_manifest(folder).get("k spacing"),
+        "energies": out_energies(folder / f"{name}.out"),
+        "timings": {plain_name(path.name): dmaout_timings(path) for path in paths
+                    if plain_name(path.name).endswith(".dmaout")},
+        "pruned": [path.name for path in paths],
+        "archive": str(archive) if archive else None,
+        "pruned at": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    record_path = folder / RECORD_NAME
+    tmp_path = record_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(record, f, indent=2)
+    os.replace(tmp_path, record_path)
+
+def archive_files(folder, paths, archive_path):
+    """Pack paths into a .tar.gz archive, written under a temporary name first.
+
+    Symlinked inputs are stored as the files they point to, so restoring
+    does not depend on the input store they linked into.
+    """
+    archive_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = archive_path.with_name(f".{archive_path.name}.tmp")
+    with tarfile.open(tmp_path, "w:gz", dereference=True) as tar:
+        for path in paths:
+            tar.add(path, arcname=path.name)
+    os.replace(tmp_path, archive_path)
+
+def save_manifest(folder, manifest):
+    manifest_path = folder / MANIFEST_NAME
+    tmp_path = manifest_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+def mark_pruned(folder, archive=None):
+    manifest = load_manifest(folder)
+    manifest["pruned"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    if archive:
+        manifest["archive"] = str(archive)
+    save_manifest(folder, manifest)
+
+def prune(root_dirs, dry_run=False, archive_dir=None):
+    """Record, then remove or archive, the intermediates of every finished folder below root_dirs."""
+    folders, files, size, inodes = 0, 0, 0, 0
+    for root_dir in root_dirs:
+        for dirpath, _, _ in os.walk(root_dir):
+            folder = Path(dirpath)
+            if is_pruned(folder) or not is_finished(folder):
+                continue
+            paths = intermediates(folder)
+            if not paths:
+                continue
+            folder_size, folder_inodes = reclaimable(paths)
+            folders += 1
+            files += len(paths)
+            size += folder_size
+            inodes += folder_inodes
+            if dry_run:
+                continue
+            archive = None
+            if archive_dir:
+                archive = Path(archive_dir) / f"{os.path.relpath(folder, Path(root_dir).parent)}.tar.gz"
+                archive_files(folder, paths, archive)
+            write_record(folder, paths, archive)
+            mark_pruned(folder, archive)
+            for path in paths:
+                path.unlink()
+    action = "Would prune" if dry_run else "Archived and pruned" if archive_dir else "Pruned"
+    print(f"{action} {files} intermediate files in {folders} finished folders: "
+          f"{size / 2**20:.1f} MB and {inodes} inodes reclaimable")
+    return folders, files, size, inodes
+
+def checked_members(tar):
+    """Yield the members of an archive, refusing any but files, and links to them, inside it.
+
+    Stands in for the "data" extraction filter on Pythons without one.
+    """
+    for member in tar.getmembers():
+        names = [member.name] + ([member.linkname] if member.islnk() else [])
+        if (not (member.isfile() or member.islnk())
+                or any(os.path.isabs(name) or ".." in Path(name).parts for name in names)):
+            raise tarfile.TarError(f"Refusing to extract {member.name}")
+        member.mode &= 0o755
+        yield member
+
+def restore(archive_path, folder):
+    """Unpack an archive made by prune back into its folder, so the folder can be rerun."""
+    folder = Path(folder)
+    with tarfile.open(archive_path, "r:gz") as tar:
+        if hasattr(tarfile, "data_filter"):
+            tar.extractall(folder, filter="data")
+        else:
+            tar.extractall(folder, members=list(checked_members(tar)))
+    manifest = load_manifest(folder)
+    manifest.pop("pruned", None)
+    manifest.pop("archive", None)
+    save_manifest(folder, manifest)
+    print(f"Restored {archive_path} into {folder}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prune the intermediates of finished structure folders.")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    prune_parser = subparsers.add_parser("prune", help="record timings and energies, then remove intermediates")
+    prune_parser.add_argument("root_dirs", nargs="+")
+    prune_parser.add_argument("--dry-run", action="store_true",
+                              help="only report the space and inodes pruning would free")
+    prune_parser.add_argument("--archive", default=None, metavar="DIR",
+                              help="pack the intermediates of each folder into DIR/<folder>.tar.gz first")
+    restore_parser = subparsers.add_parser("restore", help="unpack an archived folder")
+    restore_parser.add_argument("archive")
+    restore_parser.add_argument("folder")
+    args = parser.parse_args()
+
+    if args.action == "prune":
+        prune(args.root_dirs, args.dry_run, args.archive)
+    else:
+        restore(args.archive, args.folder)
@@ -1,16 +1,94 @@
 import subprocess
 import csv
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 
-# Define the root directory containing your folders
+from job_runner import run_script_job, preload_imports
+from output_compression import open_output, find_output
+from job_daemon import job_request, request
+from calculations import in_energy_order
+
+# Define the crystal whose structure folders are ranked
 CRYSTAL_NAME = "cumjoj"
-ROOT_DIR = f"{CRYSTAL_NAME}/structure-files"
-CSV_FILE = f"{CRYSTAL_NAME}/structures.csv"
-OUTPUT_CSV = f"{CRYSTAL_NAME}/structures-ranking.csv"
+CRYSTAL_NAMES = [CRYSTAL_NAME]  # Molecules processed in one batch, each laid out like CRYSTAL_NAME
+RUN_AUTOFREE = False  # Set to True to run AutoFree.py in every folder before ranking
+WARM_WORKERS = 0  # Set above 0 to run AutoFree.py in that many warm worker processes
+# Set to the socket of the node's job daemon to run AutoFree.py on it, by default
+# ~/.pipeline-jobs-<node>.sock or $XDG_RUNTIME_DIR/.pipeline-jobs-<node>.sock if that is set
+DAEMON_SOCKET = None
+
+def molecule_paths(crystal_name):
+    """Return the structure folder root, input CSV and ranking CSV of a molecule."""
+    return (f"{crystal_name}/structure-files", f"{crystal_name}/structures.csv",
+            f"{crystal_name}/structures-ranking.csv")
+
+def autofree_in_warm_worker(folder):
+    """Run AutoFree.py inside a warm worker, writing {name}.out as the subprocess would."""
+    result = run_script_job({
+        "name": folder.name,
+        "args": ["python", "AutoFree.py"],
+        "cwd": str(folder),
+        "stdout": str(folder / f"{folder.name}.out"),
+    })
+    return folder, result
+
+def run_autofree_warm(root_dirs, workers):
+    """Run AutoFree.py in each folder on warm workers that import numpy/scipy only once.
+
+    root_dirs may be one structure folder root or a list of them, whose
+    folders then all share the same workers. Each root is taken in order of
+    the static energies in the structures.csv next to it.
+    """
+    if isinstance(root_dirs, (str, Path)):
+        root_dirs = [root_dirs]
+    folders = []
+    for root_dir in root_dirs:
+        for folder in in_energy_order(Path(root_dir).iterdir(), root_dir):
+            if folder.is_dir() and (folder / "AutoFree.py").exists():
+                folders.append(folder)
+            else:
+                print(f"Skipping {folder.name}: AutoFree.py not found")
+    with ProcessPoolExecutor(max_workers=workers, initializer=preload_imports) as pool:
+        for folder, result in pool.map(autofree_in_warm_worker, folders):
+            print(f"Running AutoFree.py in: {folder.name}")
+            if result["status"] == "completed":
+                print(f"Output saved to: {folder / f'{folder.name}.out'}")
+            else:
+                print(f"Error running AutoFree.py in {folder.name}: {result['stderr']}")
+
+def run_autofree_on_daemon(root_dirs, socket_path):
+    """Submit AutoFree.py in each folder to the job daemon and wait for them all.
+
+    The daemon starts them in submission order, lowest static energy first,
+    as it has room next to whatever else is running on the node.
+    """
+    if isinstance(root_dirs, (str, Path)):
+        root_dirs = [root_dirs]
+    jobs = []
+    for root_dir in root_dirs:
+        for folder in in_energy_order(Path(root_dir).iterdir(), root_dir):
+            if folder.is_dir() and (folder / "AutoFree.py").exists():
+                jobs.append({"name": str(folder), "args": ["python", "AutoFree.py"], "cwd": str(folder),
+                             "stdout": str(folder / f"{folder.name}.out")})
+            else:
+                print(f"Skipping {folder.name}: AutoFree.py not found")
+    for reply in request(job_request("run", jobs), socket_path):
+        folder = Path(reply["result"]["name"])
+        print(f"Running AutoFree.py in: {folder.name}")
+        if reply["result"]["status"] == "completed":
+            print(f"Output saved to: {folder / f'{folder.name}.out'}")
+        else:
+            print(f"Error running AutoFree.py in {folder.name}: {reply['result']['stderr']}")
 
 def run_autofree_in_folders(root_dir):
-    """Run 'python AutoFree.py > {name}.out' in each folder."""
-    for folder in Path(root_dir).iterdir():
+    """Run 'python AutoFree.py > {name}.out' in each folder, lowest static energy first."""
+    if DAEMON_SOCKET:
+        run_autofree_on_daemon(root_dir, DAEMON_SOCKET)
+        return
+    if WARM_WORKERS > 0:
+        run_autofree_warm(root_dir, WARM_WORKERS)
+        return
+    for folder in in_energy_order(Path(root_dir).iterdir(), root_dir):
         if folder.is_dir():  # Check if it's a directory
             autofree_script = folder / "AutoFree.py"
             if autofree_script.exists():
@@ -20,7 +98,7 @@ def run_autofree_in_folders(root_dir):
                     # Run the command and redirect output to the output file
                     with open(output_file, "w") as outfile:
                         subprocess.run(
-                            ["python", str(autofree_script)],
+                            ["python", "AutoFree.py"],
                             stdout=outfile,
                             stderr=subprocess.PIPE,
                             text=True,
@@ -37,7 +115,7 @@ def run_autofree_in_folders(root_dir):
 def extract_free_energy(output_file):
     """Extract the free energy from the .out file."""
     free_energy = None
-    with open(output_file, "r") as file:
+    with open_output(output_file) as file:
         for line in file:
             if "Epanechnikov KDE vibrational energy:" in line:
                 free_energy = float(line.split()[-2])  # Extract the free energy value
@@ -62,7 +140,7 @@ def process_csv(csv_file, output_csv, root_dir):
     for row in data:
         folder_name = row["id"]
         output_file = Path(root_dir) / folder_name / f"{folder_name}.out"
-        if output_file.exists():
+        if find_output(output_file):
             free_energy = extract_free_energy(output_file)
             if free_energy is not None:
                 row["free energy"] = free_energy
@@ -103,10 +181,19 @@ def process_csv(csv_file, output_csv, root_dir):
             writer.writerow({field: row.get(field, "N/A") for field in desired_fieldnames})
 
 if __name__ == "__main__":
-    # Step 1: Run AutoFree.py in each folder
-    #run_autofree_in_folders(ROOT_DIR)
+    molecules = [molecule_paths(crystal_name) for crystal_name in CRYSTAL_NAMES]
+
+    # Step 1: Run AutoFree.py in each folder, on the job daemon or in one warm pool for all molecules
+    if RUN_AUTOFREE and DAEMON_SOCKET:
+        run_autofree_on_daemon([root_dir for root_dir, _, _ in molecules], DAEMON_SOCKET)
+    elif RUN_AUTOFREE and WARM_WORKERS > 0:
+        run_autofree_warm([root_dir for root_dir, _, _ in molecules], WARM_WORKERS)
+    elif RUN_AUTOFREE:
+        for root_dir, _, _ in molecules:
+            run_autofree_in_folders(root_dir)
 
-    # Step 2: Process the CSV file and calculate rankings
-    process_csv(CSV_FILE, OUTPUT_CSV, ROOT_DIR)
+    # Step 2: Process the CSV file of each molecule and calculate rankings
+    for root_dir, csv_file, output_csv in molecules:
+        process_csv(csv_file, output_csv, root_dir)
 
     print("AutoFree.py execution and CSV processing completed")
\ No newline at end of file
@@ -0,0 +1,57 @@
+'''
+Stand-in for AutoFree.py. Checks the displaced .dmaout files, spends STUB_AUTOFREE_SECONDS and
+prints the vibrational energy lines read by the analysis scripts. The energies depend only on
+the structure name and the k-point spacing, and converge as the spacing gets finer.
+'''
+
+import os
+import sys
+import glob
+import time
+import random
+import hashlib
+
+SECONDS = float(os.environ.get("STUB_AUTOFREE_SECONDS", "0.1"))
+BUSY = os.environ.get("STUB_BUSY", "0") == "1"  # Burn CPU instead of sleeping
+FAIL_RATE = float(os.environ.get("STUB_FAIL_RATE", "0"))  # Share of runs that exit with an error
+
+def spend(seconds):
+    if not BUSY:
+        time.sleep(seconds)
+        return
+    end = time.process_time() + seconds
+    while time.process_time() < end:
+        pass
+
+base = glob.glob("*.res.dmain")
+if not base:
+    print("No .res.dmain file found", file=sys.stderr)
+    sys.exit(1)
+name = base[0][:-len(".res.dmain")]
+k_spacing = 0.12
+outputs = sorted(glob.glob(f"{name}.res_*.dmaout"))
+for output in outputs:
+    with open(output, "r") as f:
+        if "Total run time" not in f.read():
+            print(f"{output} is incomplete", file=sys.stderr)
+            sys.exit(1)
+for dmain in glob.glob(f"{name}.res_*.dmain"):
+    with open(dmain, "r") as f:
+        for line in f:
+            if "KSPACING" in line:
+                k_spacing = float(line.split()[-1])
+spend(SECONDS)
+if random.random() < FAIL_RATE:
+    print("stub failure", file=sys.stderr)
+    sys.exit(2)
+
+seed = int(hashlib.sha256(name.encode()).hexdigest()[:8], 16)
+neat = 5.0 + seed % 1000 / 100 + 2.0 * k_spacing ** 2
+kde = neat - 0.05 + 1.5 * k_spacing ** 2
+k_points = max(1, round((0.5 / k_spacing) ** 3))
+print(f"AutoFree stand-in for {name} from {len(outputs)} displaced supercells")
+print(f"Total number of sampled unique k-points: {k_points}")
+print(f"Total number of phonons is: {3 * 24 * k_points}")
+print(f"Neat vibrational energy = {neat:.6f} kJ/mol")
+print(f"Debye contribution to vibrational energy: {0.3 + 0.1 * k_spacing:.6f} kJ/mol")
+print(f"Epanechnikov KDE vibrational energy: {kde:.6f} kJ/mol")
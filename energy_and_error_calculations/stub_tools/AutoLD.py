@@ -0,0 +1,44 @@
+'''
+Stand-in for AutoLD.py. Takes -k <spacing>, spends STUB_AUTOLD_SECONDS and writes
+STUB_DISPLACEMENTS displaced <name>.res_<i>.dmain files from <name>.res.dmain.
+'''
+
+import os
+import sys
+import glob
+import time
+import random
+import argparse
+
+SECONDS = float(os.environ.get("STUB_AUTOLD_SECONDS", "0.05"))
+DISPLACEMENTS = int(os.environ.get("STUB_DISPLACEMENTS", "6"))
+BUSY = os.environ.get("STUB_BUSY", "0") == "1"  # Burn CPU instead of sleeping
+FAIL_RATE = float(os.environ.get("STUB_FAIL_RATE", "0"))  # Share of runs that exit with an error
+
+def spend(seconds):
+    if not BUSY:
+        time.sleep(seconds)
+        return
+    end = time.process_time() + seconds
+    while time.process_time() < end:
+        pass
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-k", default="0.12")
+args = parser.parse_args()
+
+base = glob.glob("*.res.dmain")
+if not base:
+    print("No .res.dmain file found", file=sys.stderr)
+    sys.exit(1)
+name = base[0][:-len(".res.dmain")]
+with open(base[0], "r") as f:
+    dmain = f.read()
+spend(SECONDS)
+if random.random() < FAIL_RATE:
+    print("stub failure", file=sys.stderr)
+    sys.exit(2)
+for i in range(DISPLACEMENTS):
+    with open(f"{name}.res_{i}.dmain", "w") as f:
+        f.write(dmain.replace("END\n", f"DISP {i} KSPACING {args.k}\nEND\n"))
+print(f"AutoLD stand-in: {DISPLACEMENTS} displaced supercells at k = {args.k}")
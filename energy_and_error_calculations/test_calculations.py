@@ -0,0 +1,53 @@
+'''
+Regression tests of calculations.py, run against the stand-in tools in stub_tools/ on a synthetic
+tree laid out by benchmark.make_tree.
+
+Usage:
+    python -m pytest test_calculations.py
+'''
+
+import os
+import sys
+import subprocess
+
+import pytest
+
+from benchmark import STUB_DIR, CALCULATIONS, CRYSTAL_NAME, make_tree
+from calculations import quarantine
+
+def run_calculations(work_dir, *args):
+    env = dict(os.environ)
+    env["PATH"] = f"{STUB_DIR}{os.pathsep}{env.get('PATH', '')}"
+    env["STUB_DMACRYS_SECONDS"] = "0"
+    return subprocess.run([sys.executable, str(CALCULATIONS)] + list(args), cwd=work_dir, env=env,
+                          capture_output=True, text=True, check=True).stdout
+
+def test_barriers_leave_quarantined_folders_alone(tmp_path):
+    make_tree(tmp_path, 2)
+    run_calculations(tmp_path, "--barriers")
+    folder = tmp_path / "structure-files" / f"{CRYSTAL_NAME}-2"
+    dmaout_files = sorted(folder.glob("*.res_*.dmaout"))
+    assert dmaout_files
+    for path in dmaout_files:
+        path.unlink()
+    quarantine(folder, "dmacrys", {"name": dmaout_files[0].with_suffix(".dmain").name, "failure": "nonzero-exit",
+                                   "returncode": 1, "stderr": ""}, 3)
+
+    output = run_calculations(tmp_path, "--barriers")
+    assert "Queued 0 pending .dmain files" in output
+    assert not any(path.exists() for path in dmaout_files)
+
+def test_scratch_runs_copy_back_everything_dmacrys_writes(tmp_path):
+    make_tree(tmp_path, 2)
+    scratch = tmp_path / "scratch"
+    run_calculations(tmp_path, "--scratch", str(scratch))
+    for folder in [path for path in (tmp_path / "structure-files").iterdir() if path.is_dir()]:
+        assert (folder / "fort.12").exists()
+        assert all("Total run time" in path.read_text() for path in folder.glob("*.dmaout"))
+    assert not any(scratch.iterdir())
+
+def test_speculation_is_refused_with_scratch(tmp_path):
+    make_tree(tmp_path, 1)
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        run_calculations(tmp_path, "--scratch", str(tmp_path / "scratch"), "--speculate")
+    assert "cannot be combined with --scratch" in error.value.stderr
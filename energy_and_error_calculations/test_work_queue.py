@@ -0,0 +1,63 @@
+'''
+Tests of work_queue.py with several worker processes racing for the tickets of one queue, and with
+a worker that dies holding a ticket.
+
+Usage:
+    python -m pytest test_work_queue.py
+'''
+
+import os
+import sys
+import time
+import signal
+import subprocess
+from pathlib import Path
+
+from work_queue import submit_commands
+
+WORK_QUEUE = Path(__file__).resolve().parent / "work_queue.py"
+
+def start_workers(queue_dir, *args):
+    """Start work_queue.py work in a session of its own, so it can be killed with its worker processes."""
+    return subprocess.Popen([sys.executable, str(WORK_QUEUE), "work", str(queue_dir)] + list(args),
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, start_new_session=True)
+
+def test_racing_workers_run_each_ticket_once(tmp_path):
+    queue_dir = tmp_path / "queue"
+    runs_dir = tmp_path / "runs"
+    runs_dir.mkdir()
+    submit_commands(queue_dir, [f"echo ran >> {runs_dir / f'{i}.txt'}" for i in range(40)])
+
+    workers = start_workers(queue_dir, "--processes", "4", "--lease", "5")
+    output, _ = workers.communicate(timeout=120)
+    assert workers.returncode == 0, output
+
+    assert sorted(int(path.stem) for path in runs_dir.iterdir()) == list(range(40))
+    assert all(path.read_text() == "ran\n" for path in runs_dir.iterdir())
+    assert len(os.listdir(queue_dir / "done")) == 40
+    assert not any(os.listdir(queue_dir / state) for state in ["pending", "running", "failed"])
+
+def test_ticket_of_a_dead_worker_runs_again(tmp_path):
+    queue_dir = tmp_path / "queue"
+    runs = tmp_path / "runs.txt"
+    release = tmp_path / "release"
+    submit_commands(queue_dir, [f"echo ran >> {runs}; [ -e {release} ] || exec sleep 5"])
+
+    doomed = start_workers(queue_dir, "--lease", "1")
+    deadline = time.monotonic() + 30
+    while not runs.exists():
+        assert time.monotonic() < deadline, "the first worker never started the ticket"
+        time.sleep(0.05)
+    os.killpg(doomed.pid, signal.SIGKILL)
+    doomed.communicate()
+    assert len(os.listdir(queue_dir / "running")) == 1
+
+    release.touch()
+    rescuer = start_workers(queue_dir, "--lease", "1")
+    output, _ = rescuer.communicate(timeout=60)
+    assert rescuer.returncode == 0, output
+
+    assert "Reclaimed" in output
+    assert runs.read_text() == "ran\nran\n"
+    assert len(os.listdir(queue_dir / "done")) == 1
+    assert not any(os.listdir(queue_dir / state) for state in ["pending", "running", "failed"])
@@ -0,0 +1,195 @@
+'''
+A job queue kept as ticket files in a directory on the shared filesystem, so any number of
+worker processes on any number of nodes can pull dmacrys/AutoFree commands from it without a
+scheduler service.
+
+Each ticket is one command line, in the same "cd <folder> ; <command>" form written by
+txt-file-generator.py and txt-file-for-autofree.py. A worker claims a ticket by renaming it from
+pending/ into running/, which only one worker can win. While the command runs the worker touches
+the ticket to keep its lease; a ticket whose lease has not been renewed for LEASE_SECONDS belongs
+to a dead worker and is moved back to pending/ by the next worker looking for work.
+
+Usage:
+    python work_queue.py submit <queue_dir> commands_1.txt [commands_2.txt ...]
+    python work_queue.py work <queue_dir> [--processes N] [--timeout SECONDS] [--pin [--numa-node N]]
+    python work_queue.py status <queue_dir>
+'''
+
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+import multiprocessing
+from pathlib import Path
+
+from job_runner import run_job_sync, core_sets, thread_env
+
+LEASE_SECONDS = 600  # A running ticket not touched for this long is handed out again
+QUEUE_STATES = ["pending", "running", "done", "failed"]
+
+def queue_dirs(queue_dir):
+    """Create the state directories of a queue and return them by name."""
+    dirs = {state: Path(queue_dir) / state for state in QUEUE_STATES}
+    for path in dirs.values():
+        path.mkdir(parents=True, exist_ok=True)
+    return dirs
+
+def submit_commands(queue_dir, commands):
+    """Write one pending ticket per command line, in submission order."""
+    dirs = queue_dirs(queue_dir)
+    prefix = f"{time.time_ns()}-{os.getpid()}"
+    count = 0
+    for command in commands:
+        command = command.strip()
+        if not command:
+            continue
+        ticket = f"{prefix}-{count:06d}.job"
+        tmp_path = Path(queue_dir) / f".{ticket}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(command + "\n")
+        os.replace(tmp_path, dirs["pending"] / ticket)
+        count += 1
+    print(f"Submitted {count} tickets to {queue_dir}")
+    return count
+
+def reclaim_expired(queue_dir, lease=LEASE_SECONDS):
+    """Move tickets whose lease has run out back to pending."""
+    dirs = queue_dirs(queue_dir)
+    now = time.time()
+    for path in dirs["running"].iterdir():
+        try:
+            expired = now - path.stat().st_mtime > lease
+            if expired:
+                ticket = path.name.split(".job.")[0] + ".job"
+                os.rename(path, dirs["pending"] / ticket)
+                print(f"Reclaimed {ticket} from {path.name.split('.job.')[-1]}")
+        except FileNotFoundError:
+            pass  # Finished or reclaimed by someone else meanwhile
+
+def claim_ticket(queue_dir, worker_id):
+    """Claim the oldest pending ticket, or return None when the queue is empty."""
+    dirs = queue_dirs(queue_dir)
+    for ticket in sorted(os.listdir(dirs["pending"])):
+        claimed = dirs["running"] / f"{ticket}.{worker_id}"
+        try:
+            # Renaming keeps the mtime, so start the lease before the ticket
+            # shows up in running/ where it could look expired
+            os.utime(dirs["pending"] / ticket)
+            os.rename(dirs["pending"] / ticket, claimed)
+        except FileNotFoundError:
+            continue  # Another worker got there first
+        return claimed
+    return None
+
+def keep_lease(claimed, stop, lease=LEASE_SECONDS):
+    """Touch a claimed ticket until stop is set, so its lease does not expire."""
+    while not stop.wait(lease / 3):
+        try:
+            os.utime(claimed)
+        except FileNotFoundError:
+            return
+
+def finish_ticket(queue_dir, claimed, status):
+    """Move a claimed ticket to done/ or failed/."""
+    dirs = queue_dirs(queue_dir)
+    ticket = claimed.name.split(".job.")[0] + ".job"
+    try:
+        os.rename(claimed, dirs["done" if status == "completed" else "failed"] / ticket)
+    except FileNotFoundError:
+        print(f"Lost the lease on {ticket}, it will run again elsewhere")
+
+def usage_text(value, unit, digits=1):
+    """Format a resource figure of a job, which is None when it could not be measured."""
+    return f"unknown {unit}" if value is None else f"{value:.{digits}f} {unit}"
+
+def work(queue_dir, timeout=None, lease=LEASE_SECONDS, cpus=None):
+    """Claim and run tickets until none are pending or running.
+
+    With cpus, the worker and every command it runs stay on those cores,
+    and OpenMP/BLAS libraries start one thread per core.
+    """
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+        os.environ.update(thread_env(len(cpus)))
+        print(f"{worker_id}: pinned to CPUs {','.join(map(str, sorted(cpus)))}")
+    completed = 0
+    while True:
+        reclaim_expired(queue_dir, lease)
+        claimed = claim_ticket(queue_dir, worker_id)
+        if claimed is None:
+            # Tickets still running elsewhere may come back if their worker dies
+            if not os.listdir(Path(queue_dir) / "running"):
+                break
+            time.sleep(min(lease / 10, 30))
+            continue
+        with open(claimed, "r") as f:
+            command = f.read().strip()
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=keep_lease, args=(claimed, stop, lease), daemon=True)
+        heartbeat.start()
+        try:
+            result = run_job_sync({"name": claimed.name, "args": ["sh", "-c", command]}, timeout)
+        finally:
+            stop.set()
+            heartbeat.join()
+        finish_ticket(queue_dir, claimed, result["status"])
+        print(f"{worker_id}: {result['status']} in {result['wall']:.1f} s wall, "
+              f"{usage_text(result['user'], 's user')}, {usage_text(result['sys'], 's sys')}, "
+              f"{usage_text(result['max_rss_kb'], 'KB peak RSS', 0)}: {command}")
+        if result["stderr"]:
+            print(f"Errors from {command}:\n{result['stderr']}")
+        completed += 1
+    print(f"{worker_id}: queue empty after {completed} tickets")
+
+def queue_status(queue_dir):
+    """Print how many tickets are in each state, and who holds the running ones."""
+    dirs = queue_dirs(queue_dir)
+    for state in QUEUE_STATES:
+        print(f"{state}: {len(os.listdir(dirs[state]))}")
+    now = time.time()
+    for path in sorted(dirs["running"].iterdir()):
+        ticket, _, worker_id = path.name.partition(".job.")
+        print(f"  {ticket}.job on {worker_id}, lease renewed {now - path.stat().st_mtime:.0f} s ago")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shared-filesystem job queue for dmacrys/AutoFree commands.")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    submit_parser = subparsers.add_parser("submit", help="add the lines of command files as tickets")
+    submit_parser.add_argument("queue_dir")
+    submit_parser.add_argument("command_files", nargs="+")
+    work_parser = subparsers.add_parser("work", help="run tickets until none are pending or running")
+    work_parser.add_argument("queue_dir")
+    work_parser.add_argument("--processes", type=int, default=1,
+                             help="worker processes to start on this node")
+    work_parser.add_argument("--timeout", type=float, default=None,
+                             help="seconds before a command is killed")
+    work_parser.add_argument("--lease", type=float, default=LEASE_SECONDS,
+                             help="seconds without a heartbeat before a ticket is handed out again")
+    work_parser.add_argument("--pin", action="store_true",
+                             help="pin each worker process to its own set of cores")
+    work_parser.add_argument("--numa-node", type=int, default=None,
+                             help="with --pin, keep every worker on the cores of this NUMA node")
+    status_parser = subparsers.add_parser("status", help="count tickets in each state")
+    status_parser.add_argument("queue_dir")
+    args = parser.parse_args()
+
+    if args.action == "submit":
+        commands = []
+        for command_file in args.command_files:
+            with open(command_file, "r") as f:
+                commands.extend(f.readlines())
+        submit_commands(args.queue_dir, commands)
+    elif args.action == "work":
+        cpu_sets = core_sets(args.processes, args.numa_node) if args.pin else [None] * args.processes
+        workers = [multiprocessing.Process(target=work, args=(args.queue_dir, args.timeout, args.lease, cpus))
+                   for cpus in cpu_sets]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        sys.exit(max(worker.exitcode for worker in workers))
+    else:
+        queue_status(args.queue_dir)